@@ -22,8 +22,27 @@
 
 import os
 import sys
+import array
+import itertools
+import collections
+import math
+import getopt
+import bisect
+import cStringIO
+import gzip
+import mmap
+import tempfile
+import subprocess
+import types
+import multiprocessing
 import evdev
 
+try:
+	# optional accelerator, built with the C sources of the test suite
+	import _evemu_tokenizer
+except ImportError:
+	_evemu_tokenizer = None
+
 # Sometimes, the events within a frame (between two EV_SYN events) may not be
 # ordered in the same way.
 # This comparison is not sensitive to this problem.
@@ -43,7 +62,12 @@ class Event(object):
 		self.extra = False
 
 	def copy(self):
-		s = Event(self.time, self.type, self.code, self.value)
+		# the fields are already converted, skip __init__()
+		s = Event.__new__(Event)
+		s.time = self.time
+		s.type = self.type
+		s.code = self.code
+		s.value = self.value
 		s.extra = self.extra
 		return s
 
@@ -177,13 +201,28 @@ class AbsInfo(object):
 		return str
 
 class EvemuFile(object):
+	# convert the events by blocks with tokenize_events(), the lines are
+	# parsed one by one otherwise
+	use_tokenizer = True
+
+	# number of processes parsing the big recordings by chunks, and the
+	# minimum size of a chunk
+	parse_jobs = 1
+	chunk_size = 32 << 20
+
+	# number of frames between two checkpoints of the index
+	index_interval = 10000
+
 	syn_event = Event("0", "0000", "0000", "0")
 	syn_event.extra = True
 
 	syn_k_event = Event("0", "0000", "0000", "1")
 	syn_k_event.extra = True
 
-	def __init__(self, file):
+	def __init__(self, file, lazy = False, window = None):
+		''' if lazy is set, only the description is parsed, and the events
+		are parsed on the first access to the frames. The file has then to
+		be kept opened until then. '''
 		self.file = file
 		self.name = None
 		self.version = EvemuFile.make_version(1, 0)
@@ -192,35 +231,290 @@ class EvemuFile(object):
 		self.pid = None
 		self.fw_version = None
 		self.absinfo = []
-		self.frames = []
+		self._frames = None
+		# the canonical hash of each frame and the rolling digest of the
+		# whole recording, both computed while parsing
+		self._hashes = []
+		self._digest = 0
 		self.extra_descr = []
-		self.parse_evemu(file)
+		self.events_offset = 0
+		self.events_line = 1
+		# number of frames terminated, and the one of each frame when
+		# parsing a chunk
+		self._syn_count = 0
+		self._frame_syns = None
+		# state_key() of the parser after 1, 2, 4, 8... frames when
+		# parsing a chunk
+		self._snapshots = None
+		# the checkpoints of the state when writing an index
+		self._checkpoints = None
+		# only the frames of the Window window are parsed, after
+		# skipped_frames frames
+		self.window = window
+		self.skipped_frames = 0
+		if file:
+			self.parse_header(file)
+		if file and not lazy:
+			self.parse_events()
+
+	@property
+	def frames(self):
+		if self._frames is None:
+			self.parse_events()
+		return self._frames
+
+	@property
+	def hashes(self):
+		if self._frames is None:
+			self.parse_events()
+		return self._hashes
+
+	@property
+	def digest(self):
+		if self._frames is None:
+			self.parse_events()
+		return self._digest
+
+	def parse_header(self, file):
+		n = 1
+		while True:
+			offset = file.tell()
+			line = file.readline()
+			if not line or line.startswith('E:'):
+				break
+			self.parse_descr(line)
+			n += 1
+		# remember where the events start
+		self.events_offset = offset
+		self.events_line = n
 
-	def parse_evemu(self, file):
+	def set_window(self, window):
+		self.window = window
+		self._frames = None
+
+	def parse_events(self):
+		file = self.file
+		if self.window:
+			self.parse_window()
+			return
+		if EvemuFile.parse_jobs > 1 and get_pool() and \
+		   isinstance(file, types.FileType) and self._checkpoints is None and \
+		   self.parse_events_chunked(EvemuFile.parse_jobs):
+			return
+		file.seek(self.events_offset)
+		self._frames = []
+		self._hashes = []
+		self._digest = 0
+		self.parse_blocks(read_blocks(file), InputObj(), self.events_line, True)
+		self.drop_disconnect_frame()
+
+	def parse_blocks(self, blocks, input, n, eof, time = "0"):
+		''' parses the events from the state input, and terminates the last
+		frame if eof is set. time is the one of the last event parsed. '''
 		frame = []
-		input = InputObj()
 		slot = input.current_slot
-		n = 1
-		time = "0"
-		for line in file.readlines():
-			if line.startswith('E:'):
-				# remove end of lines comments
+		for block in blocks:
+			tokens = None
+			if EvemuFile.use_tokenizer:
+				tokens = tokenize_events(block)
+			if tokens:
+				# fast path, the block only contains events
+				for event in itertools.imap(Event, *tokens):
+					frame, slot, time = self.process_event(event, frame, input, slot, n)
+					n += 1
+				continue
+			for line in block.splitlines(True):
+				if line.startswith('E:'):
+					# remove end of lines comments
+					stripped_line = line[:line.find('#')].rstrip('\t ')
+					frame, slot, time = self.parse_event(stripped_line, frame, input, slot, n)
+				else:
+					self.parse_descr(line)
+				n += 1
+		if eof:
+			if slot:
+				EvemuFile.terminate_slot(slot, frame)
+			self.terminate_frame(n, None, frame, input, time)
+		return input
+
+	def parse_lines(self, file, input, n, syns, eof, time = "0"):
+		''' parses the events from the state input until syns frames have
+		been terminated, and terminates the last frame at the end of file if
+		eof is set. time is the one of the last event parsed. Returns the
+		number and the time of the last line parsed, so that the parse can
+		go on from there. '''
+		frame = []
+		slot = input.current_slot
+		for line in iter(file.readline, ''):
+			tokens = None
+			if EvemuFile.use_tokenizer:
+				tokens = tokenize_events(line)
+			if tokens:
+				# same events as parse_blocks()
+				for event in itertools.imap(Event, *tokens):
+					frame, slot, time = self.process_event(event, frame, input, slot, n)
+			elif line.startswith('E:'):
 				stripped_line = line[:line.find('#')].rstrip('\t ')
 				frame, slot, time = self.parse_event(stripped_line, frame, input, slot, n)
 			else:
 				self.parse_descr(line)
 			n += 1
-		if slot:
-			EvemuFile.terminate_slot(slot, frame)
-		self.terminate_frame(n, None, frame, input, time)
+			if self._syn_count >= syns:
+				return n, time
+		if eof:
+			if slot:
+				EvemuFile.terminate_slot(slot, frame)
+			self.terminate_frame(n, None, frame, input, time)
+		return n, time
+
+	def parse_events_chunked(self, jobs):
+		''' parses the events by chunks in jobs processes, returns False if
+		the file is too small to be split '''
+		chunks = split_chunks(self.file, self.events_offset, self.events_line, EvemuFile.chunk_size, jobs)
+		if len(chunks) < 2:
+			return False
+
+		path = "/proc/%d/fd/%d" % (os.getpid(), self.file.fileno())
+		args = [(path, start, end, n, i == 0, i == len(chunks) - 1) for i, (start, end, n) in enumerate(chunks)]
+		pending = [get_pool().apply_async(parse_chunk, (a,)) for a in args]
+		results = []
+		try:
+			for r in pending:
+				results.append(r.get())
+		except Exception:
+			# the files of the chunks parsed by the other workers
+			for r in pending:
+				r.wait()
+				if r.successful():
+					r.get()[0].close()
+			raise
+
+		self._frames = []
+		self._hashes = []
+		self._digest = 0
+		state = None
+		try:
+			for i in xrange(len(chunks)):
+				start, end, n = chunks[i]
+				eof = i == len(chunks) - 1
+				shared, input, descr, snapshots = results[i]
+				frames, hashes, syns = shared.unpack()
+				if state:
+					state, frames, hashes = self.fix_chunk(state, start, end, n, eof, frames, hashes, syns, input, snapshots)
+				else:
+					# the first chunk starts from the real state
+					state = input
+				join_frames(self._frames, self._hashes, frames, hashes)
+				for line in descr:
+					self.parse_descr(line)
+		finally:
+			for shared, input, descr, snapshots in results:
+				shared.close()
+		for h in self._hashes:
+			self._digest = (self._digest * 1000003 + h) & 0xffffffffffffffff
+		self.drop_disconnect_frame()
+		return True
+
+	def fix_chunk(self, state, start, end, n, eof, frames, hashes, syns, input, snapshots):
+		''' the chunk has been parsed from an empty state into input instead
+		of state: parses it again from state until both parses reach the
+		same state (see snapshots), and returns the real state at the end of
+		the chunk and the real frames and hashes of the chunk '''
+		self.file.seek(start)
+		data = cStringIO.StringIO(self.file.read(end - start))
+		chunk = EvemuFile(None)
+		chunk._frames = []
+		chunk.parse_descr = lambda line: None
+		# the slot -1 gets the MT events sent before the first ABS_MT_SLOT
+		unknown_slot = input.slots.pop(-1, None)
+		# the slots never selected in the chunk keep their state
+		untouched = dict([(number, slot) for number, slot in state.slots.items() if not input.slots.has_key(number)])
+		time = "0"
+		for syn in sorted(snapshots.keys()):
+			n, time = chunk.parse_lines(data, state, n, syn, eof, time)
+			if chunk._syn_count < syn:
+				# end of the chunk
+				return state, chunk._frames, chunk._hashes
+			key = state_key(state, untouched)
+			if not unknown_slot and snapshots[syn][0] == -1:
+				# no ABS_MT_SLOT yet, but the current slot was not used
+				key = (-1,) + key[1:]
+			if key == snapshots[syn]:
+				# from there, both parses give the same frames
+				input.slots.update(untouched)
+				if input.current_slot.slot_number < 0:
+					# no ABS_MT_SLOT in the whole chunk
+					input.current_slot = state.current_slot
+				kept = bisect.bisect_right(syns, syn)
+				join_frames(chunk._frames, chunk._hashes, frames[kept:], hashes[kept:])
+				return input, chunk._frames, chunk._hashes
+		# the states never match, parse the rest of the chunk again
+		chunk.parse_blocks(read_blocks(data), state, n, eof, time)
+		return state, chunk._frames, chunk._hashes
+
+	def parse_window(self):
+		''' parses the frames of the window, starting from the last checkpoint
+		before it if the file has an index '''
+		file = self.file
+		self._frames = []
+		self._hashes = []
+		self._digest = 0
+		self.skipped_frames = 0
+		input = InputObj()
+		n = self.events_line
+		time = "0"
+		offset = self.events_offset
+		checkpoint = None
+		if isinstance(file, types.FileType):
+			checkpoints = read_index(file.name)
+			if checkpoints:
+				checkpoint = self.window.find_checkpoint(checkpoints)
+		if checkpoint:
+			input = checkpoint.get_input()
+			n = checkpoint.line
+			time = checkpoint.time
+			offset = checkpoint.offset
+			self.skipped_frames = checkpoint.frame
+		file.seek(offset)
+		self.parse_blocks(self.window_blocks(read_blocks(file)), input, n, True, time)
+		self.drop_frames(lambda number, time: self.window.before(number, time) or self.window.after(number, time))
+		for h in self._hashes:
+			self._digest = (self._digest * 1000003 + h) & 0xffffffffffffffff
+
+	def window_blocks(self, blocks):
+		''' yields the blocks until a frame goes past the window, and drops
+		the frames before the window meanwhile '''
+		for block in blocks:
+			yield block
+			self.drop_frames(lambda number, time: self.window.before(number, time))
+			if self._frames and self.window.after(self.skipped_frames + len(self._frames), self._frames[-1][0]):
+				return
+
+	def drop_frames(self, outside):
+		''' drops the frames of both ends for which outside(number, time) is
+		true, number starting at 1 '''
+		start = 0
+		while start < len(self._frames) and outside(self.skipped_frames + start + 1, self._frames[start][0]):
+			start += 1
+		end = len(self._frames)
+		while end > start and outside(self.skipped_frames + end, self._frames[end - 1][0]):
+			end -= 1
+		del self._frames[end:]
+		del self._hashes[end:]
+		del self._frames[:start]
+		del self._hashes[:start]
+		self.skipped_frames += start
 
-		if len(self.frames) == 1:
-			time, n, frame = self.frames[0]
+	def drop_disconnect_frame(self):
+		if len(self._frames) == 1:
+			time, n, frame = self._frames[0]
 			if len(frame) == 1 and frame[0] == EvemuFile.syn_k_event:
 				# all keys up event sent on disconnect
 				# that means that no events were sent, we can drop the
 				# results
-				self.frames = []
+				self._frames = []
+				self._hashes = []
+				self._digest = 0
 
 	def parse_descr(self, line):
 		line = line.strip()
@@ -269,11 +563,26 @@ class EvemuFile(object):
 		major, minor = self.major_minor()
 		return "%d.%d"%(major, minor)
 
+	def frame_hashes(self):
+		return self.hashes
+
+	def add_frame(self, time, n, frame):
+		h = hash(frame_key(frame))
+		if self._hashes and h == self._hashes[-1] and same_events(self._frames[-1][2], frame):
+			# fold the runs of identical frames, they share their events
+			frame = self._frames[-1][2]
+		self._hashes.append(h)
+		self._digest = (self._digest * 1000003 + h) & 0xffffffffffffffff
+		self._frames.append((time, n, frame))
+		if self._frame_syns is not None:
+			self._frame_syns.append(self._syn_count)
+
 	@staticmethod
 	def terminate_slot(slot, frame):
 		frame.extend(slot.get_non_updated_events())
 
 	def terminate_frame(self, n, trigger, frame, input, time):
+		self._syn_count += 1
 		if len(frame) == 0 and trigger == EvemuFile.syn_event:
 			# old kernels can not set HID_QUIRK_NO_INPUT_SYNC, giving from times
 			# to times empty frames
@@ -286,19 +595,26 @@ class EvemuFile(object):
 			# EV_SYN(1) are a pain: adding them, no matter the device says
 			if EvemuFile.syn_k_event not in frame:
 				frame.append(EvemuFile.syn_k_event)
-			self.frames.append((float(time), n, frame))
+			self.add_frame(float(time), n, frame)
 		return []
 
 	def parse_event(self, line, frame, input, slot, n):
 		e, time, type, code, value = line.split(' ')
 		event = Event(time, type, code, value)
+		return self.process_event(event, frame, input, slot, n)
 
+	def process_event(self, event, frame, input, slot, n):
+		time = event.time
 		if event.type == 0 and event.code == 0:
 			if event == EvemuFile.syn_event:
 				# EV_SYN
 				if slot:
 					EvemuFile.terminate_slot(slot, frame)
 				frame = self.terminate_frame(n, event, frame, input, time)
+				if self._snapshots is not None and self._syn_count & (self._syn_count - 1) == 0:
+					self._snapshots[self._syn_count] = state_key(input)
+				if self._checkpoints is not None and self._syn_count % EvemuFile.index_interval == 0:
+					self._checkpoints.append(Checkpoint(len(self._frames), n + 1, float(time), input))
 			elif event == EvemuFile.syn_k_event:
 				if EvemuFile.syn_k_event not in frame:
 					frame.append(event)
@@ -333,6 +649,20 @@ class EvemuFile(object):
 			frame.append(event)
 		return frame, slot, time
 
+	def descr_key(self, slot = None):
+		''' returns a normalized key of the description. Two descriptions
+		matching with match_descr() share the same key, the other way
+		around is not guaranteed. match_descr() also accepts the slots
+		definition of other in place of any axis of self: the key of these
+		descriptions is the one with the axis slot replaced. '''
+		# the slots definition and the resolution are not mandatory to
+		# match, and the properties may be missing on one side
+		absinfo = [(a.code,) if a.code == "2f" else (a.code, a.minimum, a.maximum, a.fuzz, a.flat) for a in self.absinfo]
+		if slot != None:
+			absinfo[slot] = ("2f",)
+		descr = tuple([d for d in self.extra_descr if not d.startswith("P:")])
+		return self.bus, self.vid, self.pid, tuple(absinfo), descr
+
 	def match_descr(self, other, output = False, str_result = None, prefix = ""):
 		warning = False
 		if self.version != other.version:
@@ -380,11 +710,933 @@ class EvemuFile(object):
 		return True, warning
 
 def print_(str_result, line):
-	if str_result:
+	if str_result is not None:
 		str_result.append(line)
 	else:
 		print line
 
+# the recordings may be compressed, the gzip ones are handled by the gzip
+# module, the others by these commands
+compressed_suffixes = (".gz", ".xz", ".zst")
+decompressors = {
+	".xz": ["xz", "-dc"],
+	".zst": ["zstd", "-dc"],
+}
+compressors = {
+	".xz": ["xz", "-c"],
+	".zst": ["zstd", "-q", "-c"],
+}
+
+class StreamFile(object):
+	''' output of a decompression command, read as a file. It can only seek
+	back to the beginning of the line just read, which is what EvemuFile
+	needs, or to the beginning of the file, which runs the command again. '''
+	def __init__(self, args):
+		self.args = args
+		self.start()
+
+	def start(self):
+		self.process = subprocess.Popen(self.args, stdout=subprocess.PIPE)
+		self.file = self.process.stdout
+		self.offset = 0
+		self.pending = ''
+		self.last_line = ''
+
+	def tell(self):
+		return self.offset
+
+	def seek(self, offset, whence = 0):
+		if whence == 0 and offset == self.offset:
+			return
+		if whence == 0 and self.last_line and offset == self.offset - len(self.last_line):
+			self.pending = self.last_line
+			self.last_line = ''
+			self.offset = offset
+			return
+		if whence == 0 and offset == 0:
+			self.close()
+			self.start()
+			return
+		raise IOError("can not seek in the output of " + ' '.join(self.args))
+
+	def readline(self):
+		line = self.pending
+		self.pending = ''
+		if not line:
+			line = self.file.readline()
+		self.last_line = line
+		self.offset += len(line)
+		return line
+
+	def read(self, size = -1):
+		data = self.pending
+		self.pending = ''
+		if size < 0:
+			data += self.file.read()
+		elif size > len(data):
+			data += self.file.read(size - len(data))
+		self.last_line = ''
+		self.offset += len(data)
+		return data
+
+	def readlines(self):
+		return list(iter(self.readline, ''))
+
+	def __iter__(self):
+		return iter(self.readline, '')
+
+	def close(self):
+		self.file.close()
+		if self.process.poll() == None:
+			self.process.terminate()
+		self.process.wait()
+
+class CompressorFile(object):
+	''' writes a file through a compression command '''
+	def __init__(self, args, path):
+		self.output = open(path, 'wb')
+		self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=self.output)
+
+	def write(self, data):
+		self.process.stdin.write(data)
+
+	def close(self):
+		self.process.stdin.close()
+		self.process.wait()
+		self.output.close()
+
+def compression_suffix(path):
+	for suffix in compressed_suffixes:
+		if path.endswith(suffix):
+			return suffix
+	return None
+
+def open_recording(path):
+	''' opens a recording for reading, decompressing it on the fly
+	according to its suffix '''
+	suffix = compression_suffix(path)
+	if suffix == ".gz":
+		return gzip.open(path, 'rb')
+	elif suffix:
+		return StreamFile(decompressors[suffix] + [path])
+	return open(path, 'r')
+
+def create_recording(path):
+	''' opens a recording for writing, compressing it according to its
+	suffix '''
+	suffix = compression_suffix(path)
+	if suffix == ".gz":
+		return gzip.open(path, 'wb')
+	elif suffix:
+		return CompressorFile(compressors[suffix], path)
+	return open(path, 'w')
+
+def read_blocks(file, size = 1 << 22):
+	''' reads file by blocks of complete lines '''
+	while True:
+		block = file.read(size)
+		if not block:
+			return
+		if not block.endswith('\n'):
+			block += file.readline()
+		yield block
+
+class Checkpoint(object):
+	''' the state of the parser (InputObj) after a frame, and where to resume
+	the parsing: after frame frames, at the line line (and the offset offset
+	in the file). time is the time of the last SYN_REPORT. '''
+	def __init__(self, frame, line, time, input = None):
+		self.frame = frame
+		self.line = line
+		self.offset = None
+		self.time = time
+		self.current_slot = 0
+		self.absevents = []
+		self.slots = []
+		if input:
+			self.current_slot = input.current_slot.slot_number
+			self.absevents = sorted([(code, e.value) for code, e in input.absevents.items()])
+			for number, slot in sorted(input.slots.items()):
+				self.slots.append((number, sorted([(code, e.value) for code, e in slot.events.items()])))
+
+	def get_input(self):
+		''' returns the state of the parser at the checkpoint '''
+		input = InputObj()
+		input.slots = {}
+		for number, values in self.slots:
+			slot = Slot(number)
+			for code, value in values:
+				slot.add_event(Event(0, 3, code, value))
+			for event in slot.events.values():
+				event.updated = False
+			input.slots[number] = slot
+		for code, value in self.absevents:
+			event = Event(0, 3, code, value)
+			event.updated = False
+			input.absevents[code] = event
+		input.current_slot = input.slots[self.current_slot]
+		return input
+
+	def write(self, output):
+		output.write("C: %d %d %d %r %d\n" % (self.frame, self.line, self.offset, self.time, self.current_slot))
+		output.write("A:%s\n" % "".join([" %x %d" % item for item in self.absevents]))
+		for number, values in self.slots:
+			output.write("S: %d%s\n" % (number, "".join([" %x %d" % item for item in values])))
+
+class Window(object):
+	''' a range of frames, numbered from 1 as in the .evd dumps, and/or a
+	range of times in seconds. The bounds are included, None meaning no
+	limit. '''
+	def __init__(self, first = None, last = None, start = None, end = None):
+		self.first = first
+		self.last = last
+		self.start = start
+		self.end = end
+
+	@staticmethod
+	def from_strings(frames = None, times = None):
+		''' builds a window from "FIRST:LAST" frames and "START:END" times,
+		any bound being optional. Raises ValueError. '''
+		window = Window()
+		if frames:
+			window.first, window.last = [int(i) if i else None for i in frames.split(':')]
+		if times:
+			window.start, window.end = [float(i) if i else None for i in times.split(':')]
+		return window
+
+	def before(self, number, time):
+		return (self.first != None and number < self.first) or \
+			(self.start != None and time < self.start)
+
+	def after(self, number, time):
+		return (self.last != None and number > self.last) or \
+			(self.end != None and time > self.end)
+
+	def find_checkpoint(self, checkpoints):
+		frame = None
+		if self.first != None:
+			frame = self.first - 1
+		return find_checkpoint(checkpoints, frame, self.start)
+
+	def __str__(self):
+		bound = lambda b: "" if b == None else str(b)
+		windows = []
+		if self.first != None or self.last != None:
+			windows.append("frames " + bound(self.first) + ":" + bound(self.last))
+		if self.start != None or self.end != None:
+			windows.append("times " + bound(self.start) + ":" + bound(self.end))
+		return ", ".join(windows)
+
+def index_path(path):
+	return path + ".idx"
+
+def write_index(path):
+	''' parses the recording path and writes its index: a checkpoint every
+	EvemuFile.index_interval frames. Returns the checkpoints. '''
+	f = open(path, 'r')
+	evemu = EvemuFile(f, True)
+	evemu._checkpoints = []
+	evemu.parse_events()
+	checkpoints = evemu._checkpoints
+	offsets = line_offsets(f, evemu.events_offset, evemu.events_line, [c.line for c in checkpoints])
+	for c, offset in zip(checkpoints, offsets):
+		c.offset = offset
+	f.close()
+	stat = os.stat(path)
+	output = open(index_path(path), 'w')
+	output.write("# evemu index, a checkpoint every %d frames\n" % EvemuFile.index_interval)
+	output.write("F: %d %r\n" % (stat.st_size, stat.st_mtime))
+	for c in checkpoints:
+		c.write(output)
+	output.close()
+	return checkpoints
+
+def read_index(path):
+	''' returns the checkpoints of the index of the recording path, or None
+	if it has no index or if the index is outdated '''
+	try:
+		f = open(index_path(path), 'r')
+	except IOError:
+		return None
+	stat = os.stat(path)
+	checkpoints = []
+	for line in f:
+		line = line.rstrip('\n')
+		if line.startswith('#') or not line:
+			continue
+		tag, fields = line.split(':', 1)
+		fields = fields.split()
+		if tag == "F":
+			if int(fields[0]) != stat.st_size or float(fields[1]) != stat.st_mtime:
+				f.close()
+				return None
+		elif tag == "C":
+			c = Checkpoint(int(fields[0]), int(fields[1]), float(fields[3]))
+			c.offset = int(fields[2])
+			c.current_slot = int(fields[4])
+			checkpoints.append(c)
+		elif tag == "A":
+			c.absevents = [(int(fields[i], 16), int(fields[i + 1])) for i in xrange(0, len(fields), 2)]
+		elif tag == "S":
+			values = [(int(fields[i], 16), int(fields[i + 1])) for i in xrange(1, len(fields), 2)]
+			c.slots.append((int(fields[0]), values))
+	f.close()
+	return checkpoints
+
+def find_checkpoint(checkpoints, frame = None, time = None):
+	''' returns the last checkpoint before the frame number frame (from 0)
+	or before the time time, None if the parsing has to start from the
+	beginning '''
+	result = None
+	if frame == None and time == None:
+		return None
+	for c in checkpoints:
+		if frame != None and c.frame > frame:
+			break
+		if time != None and c.time >= time:
+			break
+		result = c
+	return result
+
+def line_offsets(file, offset, line, lines):
+	''' returns the offsets in file of the sorted line numbers lines, the
+	line line being at offset '''
+	offsets = []
+	file.seek(offset)
+	i = 0
+	for block in read_blocks(file):
+		pos = 0
+		while i < len(lines) and lines[i] - line <= block.count('\n', pos):
+			while line < lines[i]:
+				pos = block.index('\n', pos) + 1
+				line += 1
+			offsets.append(offset + pos)
+			i += 1
+		line += block.count('\n', pos)
+		offset += len(block)
+	return offsets
+
+def split_chunks(file, offset, n, size, jobs):
+	''' splits the events of file after offset in chunks of at least size
+	bytes, ending on a SYN_REPORT line. Returns the list of (start, end,
+	first line number) '''
+	file.seek(0, os.SEEK_END)
+	end = file.tell()
+	size = max(size, (end - offset) / (jobs * 4) + 1)
+	chunks = []
+	start = offset
+	while start < end:
+		file.seek(start + size)
+		stop = end
+		if start + size < end:
+			# the rest of the current line, and the lines until the end of
+			# the frame
+			file.readline()
+			for line in iter(file.readline, ''):
+				fields = line.split()
+				if len(fields) > 4 and fields[0] == "E:" and fields[2:5] == ["0000", "0000", "0000"]:
+					break
+			stop = file.tell()
+		chunks.append((start, stop, n))
+		file.seek(start)
+		n += file.read(stop - start).count('\n')
+		start = stop
+	return chunks
+
+def state_key(input, ignored = ()):
+	''' the state of the parser (InputObj) which matters for the next
+	frames: two parses reaching the same key produce the same frames from
+	there. The slots ignored and the slot -1 of the chunks (MT events
+	before any ABS_MT_SLOT) are left aside. '''
+	absevents = tuple([(code, e.value, e.updated) for code, e in sorted(input.absevents.items())])
+	slots = []
+	for number, slot in sorted(input.slots.items()):
+		if number < 0 or number in ignored:
+			continue
+		slots.append((number, tuple([(code, e.value, e.updated) for code, e in sorted(slot.events.items())])))
+	return input.current_slot.slot_number, absevents, tuple(slots)
+
+def parse_chunk(args):
+	''' parses the events of a chunk of the file path, from an empty
+	state. The current slot of the first chunk is 0, the one of the others
+	is unknown '''
+	path, start, end, n, first, eof = args
+	f = open(path, 'r')
+	f.seek(start)
+	data = f.read(end - start)
+	f.close()
+	chunk = EvemuFile(None)
+	chunk._frames = []
+	chunk._frame_syns = []
+	descr = []
+	chunk.parse_descr = descr.append
+	input = InputObj()
+	if not first:
+		del input.slots[0]
+		input.current_slot = Slot(-1)
+		chunk._snapshots = {}
+	chunk.parse_blocks(read_blocks(cStringIO.StringIO(data)), input, n, eof)
+	shared = SharedFrames(pack_frames(chunk._frames, chunk._hashes, chunk._frame_syns))
+	return shared, input, descr, chunk._snapshots
+
+def pack_frames(frames, hashes, syns):
+	''' packs the frames in strings, much faster to pickle than the events.
+	The time of the events is the one of their frame. '''
+	events = [e for time, n, frame in frames for e in frame]
+	arrays = [
+		array.array('d', [time for time, n, frame in frames]),
+		array.array('l', [n for time, n, frame in frames]),
+		array.array('l', [len(frame) for time, n, frame in frames]),
+		array.array('H', [e.type for e in events]),
+		array.array('H', [e.code for e in events]),
+		array.array('l', [e.value for e in events]),
+		array.array('l', [i for i in xrange(len(events)) if events[i].extra]),
+		array.array('l', hashes),
+		array.array('l', syns),
+	]
+	return tuple([(a.typecode, a.tostring()) for a in arrays])
+
+class SharedFrames(object):
+	''' the frames packed by pack_frames() in a file of /dev/shm: only its
+	name is pickled, the receiving process maps it instead of reading the
+	data through a pipe. The receiver calls close() once unpacked. '''
+	shm_dir = "/dev/shm"
+
+	def __init__(self, packed):
+		dir = None
+		if os.path.isdir(SharedFrames.shm_dir):
+			dir = SharedFrames.shm_dir
+		fd, self.path = tempfile.mkstemp(prefix = "hid-test-", dir = dir)
+		# (typecode, offset, size) of each array
+		self.layout = []
+		self.size = 0
+		output = os.fdopen(fd, 'wb')
+		try:
+			for typecode, data in packed:
+				output.write(data)
+				self.layout.append((typecode, self.size, len(data)))
+				self.size += len(data)
+			output.close()
+		except:
+			output.close()
+			self.close()
+			raise
+
+	def unpack(self):
+		''' returns the frames, hashes and numbers of the frames '''
+		f = open(self.path, 'rb')
+		if not self.size:
+			f.close()
+			return unpack_frames([(typecode, '') for typecode, offset, size in self.layout])
+		data = mmap.mmap(f.fileno(), self.size, access = mmap.ACCESS_READ)
+		try:
+			return unpack_frames([(typecode, buffer(data, offset, size)) for typecode, offset, size in self.layout])
+		finally:
+			data.close()
+			f.close()
+
+	def close(self):
+		try:
+			os.unlink(self.path)
+		except OSError:
+			pass
+
+def unpack_frames(packed):
+	''' returns the frames, hashes and numbers of the frames packed by
+	pack_frames() '''
+	arrays = []
+	for typecode, data in packed:
+		a = array.array(typecode)
+		a.fromstring(data)
+		arrays.append(a)
+	times, lines, lengths, types, codes, values, extras, hashes, syns = arrays
+	event_times = itertools.chain.from_iterable(itertools.imap(itertools.repeat, times, lengths))
+	events = map(Event, event_times, types, codes, values)
+	for i in extras:
+		events[i].extra = True
+	frames = []
+	start = 0
+	for time, n, length in itertools.izip(times, lines, lengths):
+		frame = events[start:start + length]
+		if frames and hashes[len(frames)] == hashes[len(frames) - 1] and same_events(frames[-1][2], frame):
+			# same folding as EvemuFile.add_frame()
+			frame = frames[-1][2]
+		frames.append((time, n, frame))
+		start += length
+	return frames, hashes.tolist(), syns.tolist()
+
+def join_frames(frames, hashes, more, more_hashes):
+	''' appends the frames more parsed apart to frames, the run of
+	identical frames across the seam being folded as by
+	EvemuFile.add_frame() '''
+	if frames and more and more_hashes[0] == hashes[-1] and same_events(frames[-1][2], more[0][2]):
+		first = more[0][2]
+		more = list(more)
+		i = 0
+		while i < len(more) and more[i][2] is first:
+			time, n, frame = more[i]
+			more[i] = (time, n, frames[-1][2])
+			i += 1
+	frames.extend(more)
+	hashes.extend(more_hashes)
+
+# worker processes of the chunked parse and of compare_variants(), see
+# start_pool()
+worker_pool = None
+worker_pool_owner = None
+
+def start_pool(jobs):
+	''' creates the jobs worker processes of the chunked parse and of
+	compare_variants(). They are forked, so this has to be done before
+	starting any thread. '''
+	global worker_pool, worker_pool_owner
+	if not worker_pool:
+		worker_pool = multiprocessing.Pool(jobs)
+		worker_pool_owner = os.getpid()
+	return worker_pool
+
+def stop_pool():
+	global worker_pool, worker_pool_owner
+	if worker_pool:
+		worker_pool.close()
+		worker_pool.join()
+	worker_pool = None
+	worker_pool_owner = None
+
+def get_pool():
+	''' returns the worker processes, None in the workers themselves '''
+	if worker_pool_owner != os.getpid():
+		return None
+	return worker_pool
+
+def tokenize_events(block):
+	''' converts a block of events lines in packed arrays (time, type, code,
+	value) in one pass. Returns None if the accelerator is not available or
+	if the block contains anything else than well formed events lines. '''
+	if not _evemu_tokenizer:
+		return None
+	tokens = _evemu_tokenizer.tokenize(block)
+	if not tokens:
+		return None
+	arrays = array.array('d'), array.array('H'), array.array('H'), array.array('l')
+	for a, packed in zip(arrays, tokens):
+		a.fromstring(packed)
+	return arrays
+
+def same_events(a, b):
+	''' whether the frames a and b are exactly the same, unlike frame_key() '''
+	if len(a) != len(b):
+		return False
+	for x, y in itertools.izip(a, b):
+		if x.type != y.type or x.code != y.code or x.value != y.value or x.extra != y.extra:
+			return False
+	return True
+
+def frame_key(events):
+	# the canonical form of a frame: the multiset of its events, where the
+	# slots values are ignored as they may be changed at each run
+	return tuple(sorted([(e.type, e.code, 0 if e.is_slot() else e.value) for e in events]))
+
+def middle_snake(a, alo, ahi, b, blo, bhi):
+	''' returns the middle snake (x, y, u, v) of the shortest edit script
+	between a[alo:ahi] and b[blo:bhi], such as a[x:u] == b[y:v] '''
+	N = ahi - alo
+	M = bhi - blo
+	delta = N - M
+	odd = delta & 1
+	# the diagonals are stored in dicts: only O(D) of them are visited
+	forward = {1: 0}
+	backward = {1: 0}
+	for d in xrange((N + M + 1) / 2 + 1):
+		for k in xrange(-d, d + 1, 2):
+			if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+				x = forward[k + 1]
+			else:
+				x = forward[k - 1] + 1
+			y = x - k
+			x0, y0 = x, y
+			while x < N and y < M and a[alo + x] == b[blo + y]:
+				x += 1
+				y += 1
+			forward[k] = x
+			if odd and -d < delta - k < d and x + backward[delta - k] >= N:
+				return alo + x0, blo + y0, alo + x, blo + y
+		for k in xrange(-d, d + 1, 2):
+			if k == -d or (k != d and backward[k - 1] < backward[k + 1]):
+				x = backward[k + 1]
+			else:
+				x = backward[k - 1] + 1
+			y = x - k
+			x0, y0 = x, y
+			while x < N and y < M and a[ahi - 1 - x] == b[bhi - 1 - y]:
+				x += 1
+				y += 1
+			backward[k] = x
+			if not odd and -d <= delta - k <= d and x + forward[delta - k] >= N:
+				return ahi - x, bhi - y, ahi - x0, bhi - y0
+	# not reached
+	return alo, blo, alo, blo
+
+def diff_sequences(a, b):
+	''' Myers' linear space diff between the sequences a and b.
+	Returns the list of hunks (a_start, a_end, b_start, b_end) where the
+	sequences differ '''
+	hunks = []
+	stack = [(0, len(a), 0, len(b))]
+	while stack:
+		alo, ahi, blo, bhi = stack.pop()
+		# strip the common prefix and suffix
+		while alo < ahi and blo < bhi and a[alo] == b[blo]:
+			alo += 1
+			blo += 1
+		while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+			ahi -= 1
+			bhi -= 1
+		if alo == ahi or blo == bhi:
+			if alo < ahi or blo < bhi:
+				hunks.append((alo, ahi, blo, bhi))
+			continue
+		x, y, u, v = middle_snake(a, alo, ahi, b, blo, bhi)
+		stack.append((u, ahi, v, bhi))
+		stack.append((alo, x, blo, y))
+	hunks.sort()
+
+	# merge the contiguous hunks
+	merged = []
+	for hunk in hunks:
+		if merged and merged[-1][1] == hunk[0] and merged[-1][3] == hunk[2]:
+			merged[-1] = (merged[-1][0], hunk[1], merged[-1][2], hunk[3])
+		else:
+			merged.append(hunk)
+	return merged
+
+def align_frames(exp, res):
+	''' returns the hunks where the frames of exp and res differ '''
+	return diff_sequences(exp.frame_hashes(), res.frame_hashes())
+
+def frames_range(start, end):
+	''' describes the frames start to end - 1 (0 based) of a hunk '''
+	if start == end:
+		if not start:
+			return 'no frames (at the start)'
+		return 'no frames (after frame %d)' % start
+	if end == start + 1:
+		return 'frame %d' % end
+	return 'frames %d-%d' % (start + 1, end)
+
+def report_alignment(exp, res, str_result = None, prefix = '', max_hunks = 20):
+	hunks = align_frames(exp, res)
+	dropped = 0
+	inserted = 0
+	changed = 0
+	for i in xrange(len(hunks)):
+		exp_start, exp_end, res_start, res_end = hunks[i]
+		c = min(exp_end - exp_start, res_end - res_start)
+		d = exp_end - exp_start - c
+		n = res_end - res_start - c
+		changed += c
+		dropped += d
+		inserted += n
+		if i >= max_hunks:
+			continue
+		line = exp.frames[exp_start][1] if exp_start < len(exp.frames) else None
+		if res_start < len(res.frames):
+			line = res.frames[res_start][1]
+		counts = []
+		for count, what in ((c, 'changed'), (d, 'dropped'), (n, 'inserted')):
+			if count:
+				counts.append('%d %s' % (count, what))
+		print_(str_result, prefix + 'line ' + str(line) + \
+			', expected ' + frames_range(exp.skipped_frames + exp_start, exp.skipped_frames + exp_end) + \
+			', got ' + frames_range(res.skipped_frames + res_start, res.skipped_frames + res_end) + ': ' + \
+			', '.join(counts))
+	if len(hunks) > max_hunks:
+		print_(str_result, prefix + '... %d more differences' % (len(hunks) - max_hunks))
+	print_(str_result, prefix + 'alignment: %d frames changed, %d dropped, %d inserted (%d expected frames)' % (changed, dropped, inserted, len(exp.frames)))
+	stats = MismatchStats()
+	stats.add_hunks(exp, res, hunks)
+	stats.report(str_result, prefix)
+
+def frame_values(frame):
+	''' returns the values of the events of frame by (type, code), without
+	the slots, the EV_SYN and the events repeated from the state '''
+	values = {}
+	for e in frame:
+		if e.extra or e.type == 0 or e.is_slot():
+			continue
+		values.setdefault((e.type, e.code), []).append(e.value)
+	return values
+
+class MismatchStats(object):
+	''' counts by (type, code) the events missing, extra and with a
+	different value between the aligned frames of two recordings, and the
+	histogram of the differences of values '''
+	def __init__(self):
+		self.missing = {}
+		self.extra = {}
+		self.changed = {}
+		# (type, code) -> {delta: count}
+		self.deltas = {}
+
+	def add_frames(self, exp_frame, res_frame):
+		exp_values = frame_values(exp_frame)
+		res_values = frame_values(res_frame)
+		for key in set(exp_values.keys()) | set(res_values.keys()):
+			exp_list = exp_values.get(key, [])
+			res_list = res_values.get(key, [])
+			# the values found on both sides are not mismatches, pair the
+			# others in order
+			common = list(res_list)
+			exp_only = []
+			for value in exp_list:
+				if value in common:
+					common.remove(value)
+				else:
+					exp_only.append(value)
+			res_only = common
+			n = min(len(exp_only), len(res_only))
+			if n:
+				self.changed[key] = self.changed.get(key, 0) + n
+				deltas = self.deltas.setdefault(key, {})
+				for i in xrange(n):
+					delta = res_only[i] - exp_only[i]
+					deltas[delta] = deltas.get(delta, 0) + 1
+			if len(exp_only) > n:
+				self.missing[key] = self.missing.get(key, 0) + len(exp_only) - n
+			if len(res_only) > n:
+				self.extra[key] = self.extra.get(key, 0) + len(res_only) - n
+
+	def add_hunks(self, exp, res, hunks):
+		''' the hunks are the ones of align_frames(exp, res): the frames
+		changed are compared one by one, the dropped ones are missing and
+		the inserted ones are extra '''
+		for exp_start, exp_end, res_start, res_end in hunks:
+			c = min(exp_end - exp_start, res_end - res_start)
+			for i in xrange(c):
+				self.add_frames(exp.frames[exp_start + i][2], res.frames[res_start + i][2])
+			for i in xrange(exp_start + c, exp_end):
+				self.add_frames(exp.frames[i][2], [])
+			for i in xrange(res_start + c, res_end):
+				self.add_frames([], res.frames[i][2])
+
+	def total(self, key):
+		return self.missing.get(key, 0) + self.extra.get(key, 0) + self.changed.get(key, 0)
+
+	def report(self, str_result = None, prefix = '', max_keys = 10, max_deltas = 3):
+		''' prints the (type, code) having the most mismatches '''
+		keys = set(self.missing.keys()) | set(self.extra.keys()) | set(self.changed.keys())
+		keys = sorted(keys, key = lambda k: (-self.total(k), k))
+		if not keys:
+			return
+		print_(str_result, prefix + 'mismatching events by type / code:')
+		for key in keys[:max_keys]:
+			stype, scode = evdev.match(*key)
+			counts = []
+			for count, what in ((self.changed.get(key, 0), 'changed'), (self.missing.get(key, 0), 'missing'), (self.extra.get(key, 0), 'extra')):
+				if count:
+					counts.append('%d %s' % (count, what))
+			line = '  %04x %04x %s / %s: ' % (key[0], key[1], stype, scode) + ', '.join(counts)
+			if self.deltas.has_key(key):
+				deltas = sorted(self.deltas[key].items(), key = lambda d: (-d[1], d[0]))
+				line += ' (deltas: ' + ', '.join(['%+d x%d' % d for d in deltas[:max_deltas]])
+				if len(deltas) > max_deltas:
+					line += ', ...'
+				line += ')'
+			print_(str_result, prefix + line)
+		if len(keys) > max_keys:
+			print_(str_result, prefix + '  ... %d more type / code' % (len(keys) - max_keys))
+
+class TimingStats(object):
+	''' distribution of the jitter between the expected and the actual
+	delays between two consecutive frames '''
+	percentiles = ("p50", "p95", "p99", "max")
+
+	def __init__(self, exp_times = None, res_times = None):
+		# index of the output in the test, set by match_sets()
+		self.output = None
+		self.count = 0
+		self.p50 = self.p95 = self.p99 = self.max = 0.0
+		if not exp_times or not res_times:
+			return
+		exp_deltas = map(float.__sub__, exp_times[1:], exp_times[:-1])
+		res_deltas = map(float.__sub__, res_times[1:], res_times[:-1])
+		jitter = sorted(map(abs, map(float.__sub__, res_deltas, exp_deltas)))
+		self.count = len(jitter)
+		if not jitter:
+			return
+		last = self.count - 1
+		self.p50 = jitter[last * 50 / 100]
+		self.p95 = jitter[last * 95 / 100]
+		self.p99 = jitter[last * 99 / 100]
+		self.max = jitter[last]
+
+	@staticmethod
+	def from_frames(exp, res):
+		return TimingStats([t for t, n, f in exp.frames], [t for t, n, f in res.frames])
+
+	@staticmethod
+	def from_string(string):
+		stats = TimingStats()
+		values = string.split()
+		for name, value in zip(TimingStats.percentiles, values):
+			setattr(stats, name, float(value))
+		stats.count = int(values[len(TimingStats.percentiles)])
+		return stats
+
+	def to_string(self):
+		return ' '.join(["%f" % getattr(self, p) for p in TimingStats.percentiles] + [str(self.count)])
+
+	def __str__(self):
+		return "jitter " + ', '.join(["%s %f" % (p, getattr(self, p)) for p in TimingStats.percentiles]) + " (%d frames)" % self.count
+
+	def exceeded_limits(self, limits):
+		''' returns the list of the percentiles greater than limits (a dict
+		percentile -> seconds) '''
+		return [p for p in TimingStats.percentiles if limits.has_key(p) and getattr(self, p) > limits[p]]
+
+	def regressions(self, baseline, factor = 2.0, margin = 0.001):
+		''' returns the list of the percentiles which got worse than factor
+		times the baseline plus margin seconds '''
+		return [p for p in TimingStats.percentiles if getattr(self, p) > getattr(baseline, p) * factor + margin]
+
+def count_events(data, chunk = 1 << 20):
+	''' returns the number of events of the evemu data (a string or a mmap),
+	and the times of the first and of the last one '''
+	count = 0
+	# the chunks overlap by the length of the pattern minus one
+	for offset in xrange(0, len(data), chunk):
+		count += data[offset:offset + chunk + 3].count("\nE: ")
+	if not count:
+		return 0, None, None
+	first = data.find("\nE: ") + 4
+	last = data.rfind("\nE: ") + 4
+	first = float(data[first:data.find(" ", first)])
+	last = float(data[last:data.find(" ", last)])
+	return count, first, last
+
+def incomplete_beta(a, b, x):
+	''' regularized incomplete beta function I_x(a, b), evaluated by its
+	continued fraction (Numerical Recipes, betai) '''
+	if x <= 0.0:
+		return 0.0
+	if x >= 1.0:
+		return 1.0
+	if x > (a + 1.0) / (a + b + 2.0):
+		# the continued fraction converges faster on the other side
+		return 1.0 - incomplete_beta(b, a, 1.0 - x)
+	front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1.0 - x)) / a
+	tiny = 1e-300
+	c = 1.0
+	d = 1.0 - (a + b) * x / (a + 1.0)
+	d = 1.0 / (abs(d) > tiny and d or tiny)
+	h = d
+	for m in xrange(1, 201):
+		# even and odd steps of the fraction
+		for num in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+			    -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+			d = 1.0 + num * d
+			d = 1.0 / (abs(d) > tiny and d or tiny)
+			c = 1.0 + num / c
+			c = abs(c) > tiny and c or tiny
+			h *= d * c
+		if abs(d * c - 1.0) < 3e-14:
+			break
+	return front * h
+
+def student_t_sf(t, df):
+	''' probability that a Student's t variable with df degrees of freedom
+	is greater than t, for t >= 0 '''
+	return 0.5 * incomplete_beta(df / 2.0, 0.5, df / (df + t * t))
+
+class PerfStats(object):
+	''' performance of several runs of a test: the device creation time
+	(seconds), the rate of the events (events/s) and the jitter between the
+	frames (p95 of TimingStats, seconds), None when not measured. The runs
+	are the ones of the kernel series kernel_release ("major.minor"). '''
+	metrics = ("create", "rate", "jitter")
+	units = ("s", "events/s", "s")
+	# the metrics for which higher is better
+	higher_better = ("rate",)
+
+	def __init__(self, kernel_release = None):
+		self.kernel_release = kernel_release
+		# list of tuples of the metrics
+		self.runs = []
+
+	@staticmethod
+	def read(path):
+		''' returns the runs stored in path, none if it doesn't exist '''
+		stats = PerfStats()
+		if not os.path.exists(path):
+			return stats
+		f = open(path, 'r')
+		for line in f:
+			if line.startswith("K: "):
+				stats.kernel_release = line[3:].strip()
+			if not line.startswith("R: "):
+				continue
+			values = [None] * len(PerfStats.metrics)
+			for i, value in enumerate(line[3:].split()[:len(values)]):
+				if value != "-":
+					values[i] = float(value)
+			stats.runs.append(tuple(values))
+		f.close()
+		return stats
+
+	def write(self, path):
+		output = open(path, 'w')
+		output.write("# hid-test performance: " + ' '.join(["%s (%s)" % m for m in zip(PerfStats.metrics, PerfStats.units)]) + "\n")
+		if self.kernel_release:
+			output.write("K: %s\n" % self.kernel_release)
+		for run in self.runs:
+			output.write("R: " + ' '.join([v == None and "-" or "%f" % v for v in run]) + "\n")
+		output.close()
+
+	def add_run(self, *values):
+		self.runs.append(tuple(values))
+
+	def samples(self, metric):
+		i = PerfStats.metrics.index(metric)
+		return [run[i] for run in self.runs if run[i] != None]
+
+	def __str__(self):
+		values = []
+		for metric, unit in zip(PerfStats.metrics, PerfStats.units):
+			samples = self.samples(metric)
+			if samples:
+				values.append("%s %f %s" % (metric, sum(samples) / len(samples), unit))
+		return ', '.join(values) + " (%d runs)" % len(self.runs)
+
+	def slowdowns(self, baseline, significance = 0.001, min_change = 0.1):
+		''' returns the list of (metric, baseline mean, mean, p) of the
+		metrics which got worse than the baseline by more than min_change
+		(relative), p being the one-sided p-value of Student's t-test,
+		lower than significance. Both self and the baseline need at least 2
+		runs of a metric to compare it. The variance is pooled: the runs of
+		both kernels replay the same recording on the same machine, and
+		Welch's test is far too permissive with a few runs on one side. '''
+		result = []
+		for metric in PerfStats.metrics:
+			values = [baseline.samples(metric), self.samples(metric)]
+			if len(values[0]) < 2 or len(values[1]) < 2:
+				continue
+			means = [sum(v) / len(v) for v in values]
+			diff = means[1] - means[0]
+			if metric in PerfStats.higher_better:
+				diff = -diff
+			if diff <= abs(means[0]) * min_change:
+				continue
+			df = len(values[0]) + len(values[1]) - 2
+			variance = sum([(x - mean) ** 2 for v, mean in zip(values, means) for x in v]) / df
+			# standard error of the difference of the means
+			error = (variance * (1.0 / len(values[0]) + 1.0 / len(values[1]))) ** 0.5
+			p = 0.0
+			if error:
+				p = student_t_sf(diff / error, df)
+			if p < significance:
+				result.append((metric, means[0], means[1], p))
+		return result
+
 def cleanup_properties(expected, result):
 	if abs(len(expected) - len(result)) == 1:
 		exp_prop = False
@@ -404,41 +1656,70 @@ def cleanup_properties(expected, result):
 				result = [d for d in result if not d.startswith("P:")]
 	return expected, result
 
-def compare_files(exp, res, str_result = None, prefix = '', delta_timestamp = 0):
-	''' returns ok, warning '''
+def compare_files(exp, res, str_result = None, prefix = '', delta_timestamp = 0, align = False, timings = None, window = None):
+	''' returns ok, warning
+	if align is set, a failure is followed by the report of all the
+	frames differing between the two files
+	if timings is a list, the TimingStats of the files are appended to it
+	when the files match
+	if window is set, only the frames of the Window are compared '''
 	last_expected = None
 	last_result = None
 	warning = False
 
+	if window:
+		exp.set_window(window)
+		res.set_window(window)
+
 	ret, warning = exp.match_descr(res, True, str_result, prefix)
 
 	if not ret:
 		return ret, warning
 
+	if delta_timestamp == 0 and exp.digest == res.digest and \
+	   len(exp.frames) == len(res.frames):
+		# same canonical frames, and timestamps are ignored
+		if timings is not None:
+			timings.append(TimingStats.from_frames(exp, res))
+		return True, warning
+
 	if len(exp.frames) != len(res.frames):
 		if len(exp.frames) < len(res.frames):
 			print_(str_result, prefix + 'too many events, should get only ' + str(len(exp.frames)) + ' events instead of ' + str(len(res.frames)))
 		else:
 			print_(str_result, prefix + 'too few events, should get ' + str(len(exp.frames)) + ' events instead of ' + str(len(res.frames)))
+		if align:
+			report_alignment(exp, res, str_result, prefix)
 		return False, warning
 
-	for i in xrange(len(exp.frames)):
-		exp_time, exp_line, exp_events = exp.frames[i]
-		res_time, res_line, res_events = res.frames[i]
-		if len(exp_events) != len(res_events):
-			print_(str_result, prefix + 'line ' + str(res_line) + ', frame ' + str(i + 1) + ': got ' + str(len(res_events)) + ' events instead of ' + str(len(exp_events)))
-			return False, warning
-
-		for j in xrange(len(exp_events)):
-			r = res_events[j]
-			if r.is_slot():
-				# ignore slots, as they may be changed at each run
-				continue
-			if r not in exp_events:
-				print_(str_result, prefix + 'line ' + str(res_line) + ', frame ' + str(i) + ": '"  + str(r) + "' not in " + str(exp_events))
+	exp_frames = exp.frames
+	res_frames = res.frames
+	for i in xrange(len(exp_frames)):
+		exp_time, exp_line, exp_events = exp_frames[i]
+		res_time, res_line, res_events = res_frames[i]
+		# in runs of identical frames on both sides, the events are
+		# compared only once
+		if i == 0 or exp_events is not exp_frames[i - 1][2] or res_events is not res_frames[i - 1][2]:
+			if len(exp_events) != len(res_events):
+				print_(str_result, prefix + 'line ' + str(res_line) + ', frame ' + str(res.skipped_frames + i + 1) + ': got ' + str(len(res_events)) + ' events instead of ' + str(len(exp_events)))
+				if align:
+					report_alignment(exp, res, str_result, prefix)
 				return False, warning
-			index = exp_events.index(r)
-			del(exp_events[index])
+
+			# work on a copy, the matched events are removed from the list
+			exp_events = list(exp_events)
+			for j in xrange(len(exp_events)):
+				r = res_events[j]
+				if r.is_slot():
+					# ignore slots, as they may be changed at each run
+					continue
+				if r not in exp_events:
+					print_(str_result, prefix + 'line ' + str(res_line) + ', frame ' + str(res.skipped_frames + i) + ": '"  + str(r) + "' not in " + str(exp_events))
+					if align:
+						report_alignment(exp, res, str_result, prefix)
+					return False, warning
+				index = exp_events.index(r)
+				del(exp_events[index])
 
 		# all the events are the same, now compare the sync timestamp
 		if not last_expected:
@@ -451,32 +1732,52 @@ def compare_files(exp, res, str_result = None, prefix = '', delta_timestamp = 0)
 		last_result = res_time
 
 		if delta_timestamp > 0 and abs(exp_delta - res_delta) > delta_timestamp:
-			print_(str_result, prefix + 'line ' + str(res_line) + ', frame ' + str(i) + ': timestamps differs too much -> ' + str(res_delta - exp_delta) + ' at ' + str(res_time))
+			print_(str_result, prefix + 'line ' + str(res_line) + ', frame ' + str(res.skipped_frames + i) + ': timestamps differs too much -> ' + str(res_delta - exp_delta) + ' at ' + str(res_time))
 			warning = True
 
+	if timings is not None:
+		timings.append(TimingStats.from_frames(exp, res))
 	return True, warning
 
-def compare_sets(expected_list, result_list, str_result = None, delta_timestamp = 0):
+def compare_sets(expected_list, result_list, str_result = None, delta_timestamp = 0, align = False, timings = None):
 	warning = False
-	matches = True
 	if expected_list == None:
 		return False, warning
 
-	# parse both sets
+	# parse the description of both sets, the events are parsed only
+	# when needed
 	res_list = []
 	exp_list = []
 	opened = []
 	for res in result_list:
-		if not isinstance(res, file):
-			res = open(res, 'r')
+		if isinstance(res, basestring):
+			res = open_recording(res)
 			opened.append(res)
-		res_list.append(EvemuFile(res))
+		res_list.append(EvemuFile(res, lazy = True))
 	for exp in expected_list:
-		exp = open(exp, 'r')
+		exp = open_recording(exp)
 		opened.append(exp)
-		exp_list.append(EvemuFile(exp))
-	for f in opened:
-		f.close()
+		exp_list.append(EvemuFile(exp, lazy = True))
+
+	try:
+		return match_sets(exp_list, res_list, str_result, delta_timestamp, align, timings)
+	finally:
+		for f in opened:
+			f.close()
+
+def match_sets(exp_list, res_list, str_result = None, delta_timestamp = 0, align = False, timings = None):
+	warning = False
+	matches = True
+
+	# index the expected files by their description, and by the ones
+	# having the slots definition in place of one of their axes
+	exp_index = {}
+	slot_index = {}
+	for exp_item in exp_list:
+		exp_index.setdefault(exp_item.descr_key(), []).append(exp_item)
+		for slot in xrange(len(exp_item.absinfo)):
+			if exp_item.absinfo[slot].code != "2f":
+				slot_index.setdefault(exp_item.descr_key(slot), []).append(exp_item)
 
 	i = 0
 	found = False
@@ -485,7 +1786,8 @@ def compare_sets(expected_list, result_list, str_result = None, delta_timestamp
 		if len(res_list) == 1:
 			prefix = ''
 		exp = None
-		for exp_item in exp_list:
+		key = res.descr_key()
+		for exp_item in exp_index.get(key, []) + slot_index.get(key, []):
 			if res.match_descr(exp_item)[0]:
 				exp = exp_item
 				break
@@ -500,7 +1802,9 @@ def compare_sets(expected_list, result_list, str_result = None, delta_timestamp
 				print_(str_result, prefix + 'no events received -> ignoring')
 		else:
 			found = True
-			r, w = compare_files(exp, res, str_result, prefix, delta_timestamp)
+			r, w = compare_files(exp, res, str_result, prefix, delta_timestamp, align, timings)
+			if r and timings is not None:
+				timings[-1].output = i
 			warning = warning or w
 			matches = matches and r
 
@@ -511,27 +1815,127 @@ def compare_sets(expected_list, result_list, str_result = None, delta_timestamp
 
 	return matches, warning
 
-def dump_diff(name, events_file):
+# (token, parsed captures) of the last compare_variants() in each worker
+variants_results = None
+variants_tokens = itertools.count()
+# (path, size, mtime) -> parsed expected file, the variants_cache_size
+# last ones being kept between the calls of compare_variants()
+variants_cache = collections.OrderedDict()
+variants_cache_size = 16
+
+def parse_expected(path):
+	stat = os.stat(path)
+	key = (path, stat.st_size, stat.st_mtime)
+	evemu = variants_cache.pop(key, None)
+	if evemu is None:
+		f = open_recording(path)
+		evemu = EvemuFile(f)
+		f.close()
+	variants_cache[key] = evemu
+	while len(variants_cache) > variants_cache_size:
+		variants_cache.popitem(last = False)
+	return evemu
+
+def share_evemu(evemu):
+	''' returns the description of evemu and a SharedFrames of its frames,
+	for unshare_evemu() in another process '''
+	descr = dict(evemu.__dict__)
+	for key in ("file", "_frames", "_hashes", "_frame_syns", "_snapshots", "_checkpoints"):
+		descr[key] = None
+	return descr, SharedFrames(pack_frames(evemu.frames, evemu.hashes, []))
+
+def unshare_evemu(shared):
+	''' the EvemuFile given to share_evemu(), the SharedFrames is left to
+	the process which created it '''
+	descr, frames = shared
+	evemu = EvemuFile(None)
+	evemu.__dict__.update(descr)
+	evemu._frames, evemu._hashes, syns = frames.unpack()
+	return evemu
+
+def match_expected(expected_list, res_list):
+	''' compares the captures res_list against the expected files, returns
+	ok, warning and the output of the comparison '''
+	str_result = []
+	exp_list = [parse_expected(path) for path in expected_list]
+	r, w = match_sets(exp_list, res_list, str_result)
+	return r, w, str_result
+
+def match_variant(args):
+	''' match_expected() in a worker: the captures shared by the call of
+	compare_variants() token are unpacked only once per worker '''
+	global variants_results
+	expected_list, token, shared = args
+	if not variants_results or variants_results[0] != token:
+		variants_results = None
+		variants_results = (token, [unshare_evemu(res) for res in shared])
+	return match_expected(expected_list, variants_results[1])
+
+def compare_variants(variants, result_list, jobs = 1):
+	''' compares the captures of result_list against each list of expected
+	files of variants. The captures are parsed only once, and the expected
+	files are kept between the calls (see parse_expected()). With jobs > 1,
+	the comparisons are dispatched on the workers of start_pool(), which get
+	the captures through SharedFrames, closed once all the comparisons are
+	done. Returns the list of (ok, warning, output) in the order of
+	variants. '''
+	res_list = []
+	for res in result_list:
+		if isinstance(res, basestring):
+			f = open_recording(res)
+			res_list.append(EvemuFile(f))
+			f.close()
+		else:
+			res.seek(0)
+			res_list.append(EvemuFile(res))
+
+	pool = get_pool()
+	if jobs > 1 and pool and len(variants) > 1:
+		token = (os.getpid(), variants_tokens.next())
+		shared = []
+		try:
+			for res in res_list:
+				shared.append(share_evemu(res))
+			return pool.map(match_variant, [(expected_list, token, shared) for expected_list in variants], 1)
+		finally:
+			for descr, frames in shared:
+				frames.close()
+	return [match_expected(expected_list, res_list) for expected_list in variants]
+
+def dump_diff(name, events_file, window = None):
 	to_close = []
 	if isinstance(events_file, str):
-		events_file = open(events_file, 'r')
+		events_file = open_recording(events_file)
 		to_close.append(events_file)
 	events_file.seek(0)
-	evemu_file = EvemuFile(events_file)
+	evemu_file = EvemuFile(events_file, window = window)
 	descr, frames = evemu_file.extra_descr, evemu_file.frames
 	output = open(name, 'w')
 	to_close.append(output)
-	f_number = 0
+	f_number = evemu_file.skipped_frames
 	output.write("Evemu version: %d.%d\n" % evemu_file.major_minor())
+	if window:
+		output.write("Window: %s\n" % window)
 	output.write("N: %s\n" % evemu_file.name)
 	output.write("I: %s %s %s %s\n" % (evemu_file.bus, evemu_file.vid, evemu_file.pid, evemu_file.fw_version))
 	for d in descr:
 		output.write(d + "\n")
 	for absinfo in evemu_file.absinfo:
 		output.write("%s\n" % absinfo)
-	for time, n, frame in frames:
+	j = 0
+	while j < len(frames):
+		time, n, frame = frames[j]
+		# a run of identical frames is written once
+		count = 1
+		while j + count < len(frames) and frames[j + count][2] is frame:
+			count += 1
+		j += count
 		f_number += 1
-		output.write('frame '+str(f_number) + ':\n')
+		if count == 1:
+			output.write('frame '+str(f_number) + ':\n')
+		else:
+			output.write('frames %d-%d:\n' % (f_number, f_number + count - 1))
+			f_number += count - 1
 		for i in xrange(len(frame)):
 			event = frame[i]
 			stype, scode = event.str_repr()
@@ -543,24 +1947,58 @@ def dump_diff(name, events_file):
 		f.close()
 
 if __name__ == '__main__':
-	if len(sys.argv) == 2:
-		f0 = open(sys.argv[1])
-		parsed = EvemuFile(f0)
-		name = os.path.basename(sys.argv[1]) + ".evd"
+	align = False
+	index = False
+	frames = None
+	times = None
+	optlist, args = getopt.gnu_getopt(sys.argv[1:], 'aj:Ir:t:')
+	for opt, arg in optlist:
+		if opt == '-a':
+			# report all the differing frames, not only the first one
+			align = True
+		elif opt == '-j':
+			# parse the big files in several processes
+			EvemuFile.parse_jobs = max(1, int(arg))
+		elif opt == '-I':
+			# write the index of each file
+			index = True
+		elif opt == '-r':
+			# only the frames FIRST:LAST
+			frames = arg
+		elif opt == '-t':
+			# only the frames between the times START:END
+			times = arg
+	window = None
+	if frames or times:
+		try:
+			window = Window.from_strings(frames, times)
+		except ValueError:
+			print "invalid window, expecting FIRST:LAST frames and START:END seconds."
+			sys.exit(1)
+	if EvemuFile.parse_jobs > 1:
+		start_pool(EvemuFile.parse_jobs)
+	if index:
+		for path in args:
+			checkpoints = write_index(path)
+			print "indexed", path, "in", index_path(path), "(" + str(len(checkpoints)), "checkpoints)"
+		sys.exit(0)
+	if len(args) == 1:
+		f0 = open_recording(args[0])
+		name = os.path.basename(args[0]) + ".evd"
 		print "dumping output in:", name
-		dump_diff(name, f0)
+		dump_diff(name, f0, window)
 		f0.close()
 		sys.exit(0)
-	f0 = open(sys.argv[1])
-	f1 = open(sys.argv[2])
-	success, warning = compare_files(EvemuFile(f0), EvemuFile(f1))
+	f0 = open_recording(args[0])
+	f1 = open_recording(args[1])
+	success, warning = compare_files(EvemuFile(f0, lazy = True), EvemuFile(f1, lazy = True), align = align, window = window)
 	if not success:
 		print "test failed, dumping outputs in:"
-		name = os.path.basename(sys.argv[1]) + ".evd"
-		dump_diff(name, f0)
+		name = os.path.basename(args[0]) + ".evd"
+		dump_diff(name, f0, window)
 		print name
-		name = os.path.basename(sys.argv[2]) + ".evd"
-		dump_diff(name, f1)
+		name = os.path.basename(args[1]) + ".evd"
+		dump_diff(name, f1, window)
 		print name
 	else:
 		print "the too files are equivalent"
@@ -23,16 +23,101 @@
 import os
 import sys
 import re
+import getopt
+import bisect
+import hashlib
+from compare_evemu import TimingStats, compressed_suffixes, compression_suffix, open_recording
+
+kernel_release_regexp = re.compile(r"(\d+)\.(\d+)[^\d]*")
+
+# the same directory names are parsed for every .ev file
+major_minor_cache = {}
 
 def get_major_minor(string = os.uname()[2]):
-	kernel_release_regexp = re.compile(r"(\d+)\.(\d+)[^\d]*")
+	if major_minor_cache.has_key(string):
+		return major_minor_cache[string]
 	m = kernel_release_regexp.match(string)
 	if not m:
+		major_minor_cache[string] = 0
 		return 0
 	major_r, minor_r = m.groups()
 	major_r, minor_r = int(major_r), int(minor_r)
+	major_minor_cache[string] = major_r << 16 | minor_r
 	return major_r << 16 | minor_r
 
+# content-addressed store: the recordings are stored once in
+# <rootdir>/objects/<sha1[:2]>/<sha1[2:]>, and referenced in the tree by
+# <name>.ref files holding the relative path of the object
+objects_dir = "objects"
+ref_suffix = ".ref"
+
+def recording_name(path):
+	''' returns the name of the recording stored in path, without the
+	reference and compression suffixes '''
+	if path.endswith(ref_suffix):
+		path = path[:-len(ref_suffix)]
+	suffix = compression_suffix(path)
+	if suffix:
+		path = path[:-len(suffix)]
+	return path
+
+def resolve_path(path):
+	''' returns the path of the content of the recording path, which may be
+	compressed or stored as a reference '''
+	for candidate in [path] + [path + suffix for suffix in compressed_suffixes]:
+		if os.path.exists(candidate):
+			return candidate
+		if os.path.exists(candidate + ref_suffix):
+			ref = open(candidate + ref_suffix, 'r')
+			target = ref.readline().strip()
+			ref.close()
+			return os.path.normpath(os.path.join(os.path.dirname(candidate), target))
+	return path
+
+def store_file(rootdir, path):
+	''' moves path in the object store of rootdir and replaces it by a
+	reference, returns True if the content was not stored yet '''
+	sha1 = hashlib.sha1()
+	f = open(path, 'rb')
+	for data in iter(lambda: f.read(1 << 16), ''):
+		sha1.update(data)
+	f.close()
+	digest = sha1.hexdigest()
+	# the objects keep the compression suffix to be read
+	obj = os.path.join(rootdir, objects_dir, digest[:2], digest[2:] + (compression_suffix(path) or ''))
+	new = not os.path.exists(obj)
+	if new:
+		if not os.path.isdir(os.path.dirname(obj)):
+			os.makedirs(os.path.dirname(obj))
+		os.rename(path, obj)
+	else:
+		os.remove(path)
+	ref = open(path + ref_suffix, 'w')
+	ref.write(os.path.relpath(obj, os.path.dirname(path)) + "\n")
+	ref.close()
+	return new
+
+def migrate_db(rootdir):
+	''' moves all the .hid and .ev files of rootdir in its object store '''
+	count = 0
+	stored = 0
+	for root, dirs, files in os.walk(rootdir):
+		if root == rootdir and objects_dir in dirs:
+			dirs.remove(objects_dir)
+		for f in files:
+			if f.endswith(ref_suffix):
+				continue
+			name = recording_name(f)
+			if name.endswith(".hid") or name.endswith(".ev"):
+				count += 1
+				if store_file(rootdir, os.path.join(root, f)):
+					stored += 1
+	print count, "files moved in", os.path.join(rootdir, objects_dir) + ",", stored, "different contents"
+
+def format_kernel_release(kernel_release):
+	''' get_major_minor() value -> "major.minor" '''
+	return "%d.%d" % (kernel_release >> 16, kernel_release & 0xffff)
+
 class HIDTestDatabase(object):
 	def __init__(self, rootdir, kernel_release, fast_mode = False):
 		self.rootdir = rootdir
@@ -40,10 +125,26 @@ class HIDTestDatabase(object):
 		self.skipping_db = []
 		self.skipped = []
 		self.tests = []
+		self.timings = {}
 		self.fast_mode = fast_mode
 		self.kernel_release = get_major_minor(kernel_release)
 		self.database = {}
-		self.construct_db()
+		self.hid_files = []
+		self.skip_files = []
+		# ev basename -> list of (kernel_release, position in the walk, path)
+		# sorted by kernel, and the list of their kernel releases. The dumps
+		# without kernel directory are kept aside as (position, path).
+		self.ev_index = {}
+		self.ev_releases = {}
+		self.ev_unversioned = {}
+		# hid file -> sorted list of the ev basenames of its outputs
+		self.ev_names = {}
+		# perf basename -> list of (kernel_release, path) sorted by kernel,
+		# and the list of their kernel releases
+		self.perf_index = {}
+		self.perf_releases = {}
+		if rootdir:
+			self.construct_db()
 
 	def skip_test(self, hid_file):
 		rname = os.path.splitext(os.path.basename(hid_file))[0]
@@ -113,73 +214,276 @@ class HIDTestDatabase(object):
 
 		print self.get_results_count()
 
+	def dump_results(self, filename):
+		# write the results in a format that can be merged later with
+		# load_results(), the tags are the same than in report_results()
+		output = open(filename, 'w')
+		output.write("# hid-test results\n")
+		output.write("T: %d\n" % self.total_tests_count)
+		for file in self.skipped:
+			output.write("SK: %s\n" % file)
+		for file, (r, w) in self.tests:
+			tag = "EE"
+			if r and w:
+				tag = "WW"
+			elif r:
+				tag = "OK"
+			output.write("%s: %s\n" % (tag, file))
+		for file in sorted(self.timings.keys()):
+			for stats in self.timings[file]:
+				if stats.output == None:
+					output.write("TS: %s %s\n" % (stats.to_string(), file))
+				else:
+					output.write("TO: %d %s %s\n" % (stats.output, stats.to_string(), file))
+		output.close()
+
+	def load_results(self, filename):
+		results = open(filename, 'r')
+		for line in results.readlines():
+			line = line.rstrip('\n')
+			if line.startswith('#') or not line:
+				continue
+			tag, file = line.split(': ', 1)
+			if tag == "T":
+				self.incr_total_tests_count(int(file))
+			elif tag == "SK":
+				if file not in self.skipped:
+					self.skipped.append(file)
+			elif tag == "OK":
+				self.append_result(file, True, False)
+			elif tag == "WW":
+				self.append_result(file, True, True)
+			elif tag == "EE":
+				self.append_result(file, False, False)
+			elif tag == "TS":
+				# the path is the last field
+				count = len(TimingStats.percentiles) + 1
+				fields = file.split(' ', count)
+				stats = TimingStats.from_string(' '.join(fields[:count]))
+				self.timings.setdefault(fields[count], []).append(stats)
+			elif tag == "TO":
+				# the same with the index of the output first
+				count = len(TimingStats.percentiles) + 1
+				fields = file.split(' ', count + 1)
+				stats = TimingStats.from_string(' '.join(fields[1:count + 1]))
+				stats.output = int(fields[0])
+				self.timings.setdefault(fields[count + 1], []).append(stats)
+		results.close()
+
+	def get_recording_weight(self, hid_file, weight):
+		if weight == "size":
+			return os.path.getsize(resolve_path(hid_file))
+		# "duration": the timestamp of the last event of the recording
+		path = resolve_path(hid_file)
+		f = open_recording(path)
+		if not compression_suffix(path):
+			f.seek(0, os.SEEK_END)
+			f.seek(max(0, f.tell() - 4096))
+		duration = 0.0
+		for line in iter(f.readline, ''):
+			if line.startswith("E: "):
+				try:
+					duration = float(line.split()[1])
+				except (ValueError, IndexError):
+					pass
+		f.close()
+		return duration
+
+	def get_shard(self, hid_files, index, count, weight = None):
+		''' returns the hid files of the shard index (1 to count) '''
+		hid_files = sorted(hid_files)
+		if not weight:
+			return hid_files[index - 1::count]
+
+		# greedy partition: the heaviest recordings are dispatched first on
+		# the lightest shard. Ties are resolved by the path and the shard
+		# number, so that every shard computes the same partition.
+		weighted = [(self.get_recording_weight(f, weight), f) for f in hid_files]
+		weighted.sort(key = lambda item: (-item[0], item[1]))
+		loads = [(0, i) for i in xrange(count)]
+		shards = [[] for i in xrange(count)]
+		for w, f in weighted:
+			load, i = min(loads)
+			loads[i] = (load + w, i)
+			shards[i].append(f)
+		return sorted(shards[index - 1])
+
 	def construct_db(self):
-		hid_files = []
+		hid_files = set()
 		ev_files = []
-		skip_files = []
-		ev_dumps = {}
+		ev_names = set()
 		# first, retrieve all the .hid, .ev and .skip files in rootdir (first arg if given, otherwise, cwd)
 		for root, dirs, files in os.walk(self.rootdir):
+			if root == self.rootdir and objects_dir in dirs:
+				dirs.remove(objects_dir)
 			for f in files:
 				path = os.path.join(root, f)
-				if f.endswith(".hid"):
-					hid_files.append(path)
-				elif f.endswith(".ev"):
-					ev_files.append(path)
+				# the compressed recordings and the references are
+				# listed under the name of their content
+				name = recording_name(path)
+				if name.endswith(".hid"):
+					if name not in hid_files:
+						hid_files.add(name)
+						self.hid_files.append(name)
+				elif name.endswith(".ev"):
+					if name not in ev_names:
+						ev_names.add(name)
+						ev_files.append(name)
 				elif f.endswith(".skip"):
-					skip_files.append(path)
+					self.skip_files.append(path)
+				elif f.endswith(".perf"):
+					# the performance records are only meaningful
+					# for a kernel series
+					perf_kernel_release = get_major_minor(os.path.basename(root))
+					if perf_kernel_release:
+						self.perf_index.setdefault(f, []).append((perf_kernel_release, path))
+
+		# index the evemu traces by kernel release, the order of the walk
+		# is kept for the traces of the same kernel series. The references
+		# are resolved, so that the identical traces have the same path.
+		for position in xrange(len(ev_files)):
+			ev_file = ev_files[position]
+			basename = os.path.basename(ev_file)
+			ev_kernel_release = get_major_minor(os.path.basename(os.path.dirname(ev_file)))
+			if not ev_kernel_release:
+				self.ev_unversioned.setdefault(basename, (position, resolve_path(ev_file)))
+				continue
+			self.ev_index.setdefault(basename, []).append((ev_kernel_release, position, resolve_path(ev_file)))
+		for basename, dumps in self.ev_index.items():
+			dumps.sort()
+			self.ev_releases[basename] = [dump[0] for dump in dumps]
+		for basename, records in self.perf_index.items():
+			records.sort(key = lambda record: record[0])
+			self.perf_releases[basename] = [record[0] for record in records]
+
+		# retrieve the names of the expected evemu traces per hid test
+		ev_names = set(self.ev_index.keys()) | set(self.ev_unversioned.keys())
+		for hid_file in self.hid_files:
+			basename = os.path.splitext(os.path.basename(hid_file))[0]
+			self.ev_names[hid_file] = sorted([ev_name for ev_name in ev_names if basename in ev_name])
+
+		self.resolve()
 
-		# now that we have all the data, organize them:
+	def resolve(self):
+		''' selects the expected traces and the skipped tests of the current
+		kernel release '''
+		self.database = {}
+		self.skipping_db = []
 
 		# - the skipped files are the one matching the kernel:
-		for skip_file in skip_files:
+		for skip_file in self.skip_files:
 			kernel_skip = os.path.basename(os.path.dirname(skip_file))
 			rkernel_release = get_major_minor(kernel_skip)
 			if rkernel_release == self.kernel_release:
 				self.skipping_db.append(skip_file)
 
-		# - organize the evemu traces:
-		#   * if a dump is from an earlier kernel than the tested one -> skip it
-		#   * keep only the latest dump (from the more recent allowed kernel)
-		for ev_file in ev_files:
-			basename = os.path.basename(ev_file)
-			ev_kernel_release = get_major_minor(os.path.basename(os.path.dirname(ev_file)))
-			if not ev_kernel_release:
-				ev_kernel_release = self.kernel_release - 1
-			ev_dump = {
-				"path": ev_file,
-				"kernel_release": ev_kernel_release,
-			}
-			# discard dumps from earlier kernels
-			if ev_kernel_release > self.kernel_release:
-				continue
-			# keep the latest evemu dump
-			if not ev_dumps.has_key(basename) or \
-			   ev_dumps[basename]["kernel_release"] < ev_kernel_release:
-				ev_dumps[basename] = ev_dump
-
-		# - now retrieve the expected evemu traces per hid test
-		for hid_file in hid_files:
-			results = []
-			basename = os.path.splitext(os.path.basename(hid_file))[0]
-			# get all matching evemu dumps
-			for ev_file in ev_dumps.keys():
-				if basename in ev_file:
-					results.append(ev_file)
-			results.sort()
-			self.database[hid_file] = [ ev_dumps[ev_file] for ev_file in results]
+		for hid_file in self.hid_files:
+			self.database[hid_file] = self.get_expected_dumps(hid_file)
 
 		# - fast mode: skip the matching kernels evemu
 		if self.fast_mode:
-			for hid_file in hid_files:
+			for hid_file in self.hid_files:
 				results = self.database[hid_file]
 				skip = len(results) > 0
 				for r in results:
-					if r["kernel_release"] != kernel_release:
+					if r["kernel_release"] != self.kernel_release:
 						skip = False
 				if skip:
 					self.skipping_db.append(hid_file)
 
+	def set_kernel_release(self, kernel_release):
+		''' switches to another kernel release without walking the tree
+		again '''
+		self.kernel_release = get_major_minor(kernel_release)
+		self.resolve()
+
+	def get_ev_dump(self, ev_name, kernel_release):
+		''' returns the trace ev_name expected on kernel_release, or None:
+		  * the traces from later kernels are discarded
+		  * the latest allowed trace is taken
+		  * a trace without kernel directory counts as one from the previous
+		    kernel series
+		  * between traces of the same kernel series, the first one found
+		    is taken '''
+		dump = None
+		dumps = self.ev_index.get(ev_name, [])
+		releases = self.ev_releases.get(ev_name, [])
+		i = bisect.bisect_right(releases, kernel_release)
+		if i > 0:
+			# the first one found of this kernel series
+			i = bisect.bisect_left(releases, releases[i - 1])
+			release, position, path = dumps[i]
+			dump = {
+				"path": path,
+				"kernel_release": release,
+			}
+		if self.ev_unversioned.has_key(ev_name):
+			unversioned_position, unversioned_path = self.ev_unversioned[ev_name]
+			if not dump or (release, unversioned_position) < (kernel_release - 1, position):
+				dump = {
+					"path": unversioned_path,
+					"kernel_release": kernel_release - 1,
+				}
+		return dump
+
+	def get_perf_baseline(self, hid_file):
+		''' returns (kernel_release, path) of the performance record of
+		hid_file from the latest kernel series before the current one, or
+		None '''
+		name = os.path.splitext(os.path.basename(hid_file))[0] + ".perf"
+		records = self.perf_index.get(name, [])
+		i = bisect.bisect_left(self.perf_releases.get(name, []), self.kernel_release)
+		if i == 0:
+			return None
+		return records[i - 1]
+
+	def get_expected_dumps(self, hid_file, kernel_release = None):
+		''' returns the expected traces (dicts with "path" and
+		"kernel_release") of hid_file on kernel_release, which is a string or
+		a value of get_major_minor(), the current one by default '''
+		if kernel_release == None:
+			kernel_release = self.kernel_release
+		elif isinstance(kernel_release, basestring):
+			kernel_release = get_major_minor(kernel_release)
+		dumps = []
+		for ev_name in self.ev_names.get(hid_file, []):
+			dump = self.get_ev_dump(ev_name, kernel_release)
+			if dump:
+				dumps.append(dump)
+		return dumps
+
+	def get_kernel_variants(self, hid_file):
+		''' returns the list of (kernel releases, expected traces paths) of
+		hid_file for each kernel series having traces in the database, the
+		consecutive series expecting the same traces being grouped. If there
+		are traces without kernel directory, they are the last variant, with
+		the release None (the series without traces). '''
+		releases = set()
+		unversioned = []
+		for ev_name in self.ev_names.get(hid_file, []):
+			releases.update(self.ev_releases.get(ev_name, []))
+			if self.ev_unversioned.has_key(ev_name):
+				unversioned.append(self.ev_unversioned[ev_name][1])
+
+		variants = []
+		for r in sorted(releases):
+			paths = [dump["path"] for dump in self.get_expected_dumps(hid_file, r)]
+			if variants and variants[-1][1] == paths:
+				variants[-1][0].append(r)
+			else:
+				variants.append(([r], paths))
+		if unversioned:
+			variants.append(([None], unversioned))
+		return variants
+
+	def get_expected_for_kernel(self, kernel_release):
+		''' returns a dict hid file -> expected traces paths on
+		kernel_release, for all the tests of the database '''
+		expected = {}
+		for hid_file in self.hid_files:
+			expected[hid_file] = [dump["path"] for dump in self.get_expected_dumps(hid_file, kernel_release)]
+		return expected
+
 	def append_hid_file(self, filename):
 		if not self.has_key(filename):
 			self.database[filename] = []
@@ -208,15 +512,53 @@ class HIDTestDatabase(object):
 	def append_result(self, path, result, warning):
 		self.tests.append((path, (result, warning)))
 
+	def append_timings(self, path, timings):
+		if timings:
+			self.timings[path] = timings
+
+	def get_timings(self, path):
+		if not self.timings.has_key(path):
+			return []
+		return self.timings[path]
+
 def main():
 	rootdir = '.'
-	if len(sys.argv) > 1:
-		rootdir = sys.argv[1]
-
 	kernel_release = os.uname()[2]
 
+	print_expected = False
+
+	optlist, args = getopt.gnu_getopt(sys.argv[1:], 'mk:es')
+	for opt, arg in optlist:
+		if opt == '-s':
+			# move the recordings of the database in the object store
+			if len(args) > 0:
+				rootdir = args[0]
+			migrate_db(rootdir)
+			return
+		elif opt == '-k':
+			kernel_release = arg
+		elif opt == '-e':
+			print_expected = True
+		elif opt == '-m':
+			# merge the results files given by testsuite.py -o
+			database = HIDTestDatabase(None, kernel_release)
+			for results in args:
+				database.load_results(results)
+			database.report_results()
+			return
+
+	if len(args) > 0:
+		rootdir = args[0]
+
 	database = HIDTestDatabase(rootdir, kernel_release)
 
+	if print_expected:
+		# the expected outputs of every test on the kernel
+		expected = database.get_expected_for_kernel(kernel_release)
+		for hid_file in sorted(expected.keys()):
+			print hid_file + ":", ' '.join(expected[hid_file])
+		return
+
 	print "tested:"
 	print database.get_hid_files()
 	print "skipped files:"
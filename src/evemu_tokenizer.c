@@ -0,0 +1,160 @@
+/*
+ * Hid test suite / evemu events tokenizer
+ *
+ * Copyright (c) 2013 Benjamin Tissoires <benjamin.tissoires@gmail.com>
+ * Copyright (c) 2013 Red Hat, Inc.
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/*
+ * Optional accelerator of compare_evemu.py: converts a block of evemu lines
+ * "E: <time> <type> <code> <value>" into packed arrays in one pass.
+ */
+
+#include <Python.h>
+#include <stdlib.h>
+#include <string.h>
+
+static const char *
+parse_field(const char *p, const char *end, const char *charset)
+{
+	const char *start = p;
+
+	while (p < end && strchr(charset, *p) && *p)
+		p++;
+
+	return p == start ? NULL : p;
+}
+
+static PyObject *
+tokenize(PyObject *self, PyObject *args)
+{
+	const char *buf, *p, *end, *field;
+	char number[64];
+	int size;
+	Py_ssize_t lines = 0, count = 0;
+	double *times = NULL;
+	unsigned short *types = NULL, *codes = NULL;
+	long *values = NULL;
+	PyObject *result = NULL;
+
+	if (!PyArg_ParseTuple(args, "s#", &buf, &size))
+		return NULL;
+
+	end = buf + size;
+	for (p = buf; p < end; p++)
+		if (*p == '\n')
+			lines++;
+	if (size && end[-1] != '\n')
+		lines++;
+
+	times = malloc(lines * sizeof(*times) + 1);
+	types = malloc(lines * sizeof(*types) + 1);
+	codes = malloc(lines * sizeof(*codes) + 1);
+	values = malloc(lines * sizeof(*values) + 1);
+	if (!times || !types || !codes || !values) {
+		PyErr_NoMemory();
+		goto out;
+	}
+
+	p = buf;
+	while (p < end) {
+		/* "E: " */
+		if (end - p < 3 || strncmp(p, "E: ", 3))
+			goto not_events;
+		p += 3;
+
+		/* time, parsed as float() would do */
+		field = p;
+		p = parse_field(p, end, "0123456789.");
+		if (!p || p - field >= (int)sizeof(number) || p >= end || *p != ' ')
+			goto not_events;
+		if (memchr(field, '.', p - field) != memrchr(field, '.', p - field))
+			goto not_events;
+		memcpy(number, field, p - field);
+		number[p - field] = '\0';
+		times[count] = strtod(number, NULL);
+		p++;
+
+		/* type */
+		field = p;
+		p = parse_field(p, end, "0123456789abcdefABCDEF");
+		if (!p || p - field > 4 || p >= end || *p != ' ')
+			goto not_events;
+		types[count] = strtoul(field, NULL, 16);
+		p++;
+
+		/* code */
+		field = p;
+		p = parse_field(p, end, "0123456789abcdefABCDEF");
+		if (!p || p - field > 4 || p >= end || *p != ' ')
+			goto not_events;
+		codes[count] = strtoul(field, NULL, 16);
+		p++;
+
+		/* value */
+		field = p;
+		if (p < end && *p == '-')
+			p++;
+		p = parse_field(p, end, "0123456789");
+		if (!p || p - field > 18)
+			goto not_events;
+		values[count] = strtol(field, NULL, 10);
+
+		/* end of line comment */
+		while (p < end && (*p == ' ' || *p == '\t'))
+			p++;
+		if (p < end && *p == '#')
+			while (p < end && *p != '\n')
+				p++;
+		if (p < end && *p != '\n')
+			goto not_events;
+		p++;
+		count++;
+	}
+
+	result = Py_BuildValue("(s#s#s#s#)",
+			       (char *)times, (int)(count * sizeof(*times)),
+			       (char *)types, (int)(count * sizeof(*types)),
+			       (char *)codes, (int)(count * sizeof(*codes)),
+			       (char *)values, (int)(count * sizeof(*values)));
+	goto out;
+
+not_events:
+	/* let the caller parse the lines one by one */
+	Py_INCREF(Py_None);
+	result = Py_None;
+
+out:
+	free(times);
+	free(types);
+	free(codes);
+	free(values);
+	return result;
+}
+
+static PyMethodDef methods[] = {
+	{"tokenize", tokenize, METH_VARARGS,
+	 "tokenize(block) -> (times, types, codes, values) as packed strings "
+	 "of doubles, unsigned shorts, unsigned shorts and longs, or None if "
+	 "the block contains anything else than events."},
+	{NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC
+init_evemu_tokenizer(void)
+{
+	Py_InitModule("_evemu_tokenizer", methods);
+}
@@ -0,0 +1,170 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Hid test suite / persistent daemon
+#
+# Copyright (c) 2012-2013 Benjamin Tissoires <benjamin.tissoires@gmail.com>
+# Copyright (c) 2012-2013 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import socket
+import json
+import getopt
+import traceback
+import multiprocessing
+import compare_evemu
+
+default_socket = "/run/hid-test.sock"
+
+# last line sent to the client, followed by the exit code of the run
+exit_marker = "#hid-test-exit "
+
+def help(argv):
+	print argv[0], "[OPTION]\n"\
+"""Keeps xi2detach and the udev monitor running, and runs the tests submitted
+by "testsuite.py -DSOCKET ...".
+Where:
+ * OPTION is:
+	-h	print the help message.
+	-sSOCKET	listen on the Unix socket SOCKET (default: %s).""" % default_socket
+
+class ClientOutput(object):
+	''' stdout of a run: the run goes on even if the client went away '''
+	def __init__(self, conn):
+		self.output = conn.makefile('w', 0)
+		self.connected = True
+
+	def write(self, data):
+		if not self.connected:
+			return
+		try:
+			self.output.write(data)
+		except (IOError, socket.error):
+			self.connected = False
+
+	def flush(self):
+		pass
+
+	def close(self):
+		try:
+			self.output.close()
+		except (IOError, socket.error):
+			pass
+
+def run_job(conn):
+	import testsuite
+
+	request = conn.makefile('r')
+	job = json.loads(request.readline())
+	request.close()
+
+	output = ClientOutput(conn)
+	stdout = sys.stdout
+	cwd = os.getcwd()
+	code = 0
+	sys.stdout = output
+	try:
+		os.chdir(job["cwd"].encode('utf-8'))
+		testsuite.main([a.encode('utf-8') for a in job["argv"]])
+	except SystemExit, e:
+		code = e.code
+		if code == None:
+			code = 0
+	except Exception:
+		traceback.print_exc(file = output)
+		code = 1
+	finally:
+		sys.stdout = stdout
+		os.chdir(cwd)
+	output.write(exit_marker + "%d\n" % code)
+	output.close()
+
+def serve(path):
+	import testsuite
+
+	if os.path.exists(path):
+		os.unlink(path)
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(path)
+	server.listen(1)
+
+	# the expensive setup is done only once, the workers of -P being
+	# forked before the threads of the udev observer
+	testsuite.persistent = True
+	compare_evemu.start_pool(multiprocessing.cpu_count())
+	testsuite.start_udev_observer()
+	testsuite.start_xi2detach()
+	print "listening on", path
+	try:
+		while True:
+			conn, addr = server.accept()
+			try:
+				run_job(conn)
+			finally:
+				conn.close()
+	finally:
+		testsuite.persistent = False
+		testsuite.stop_xi2detach()
+		compare_evemu.stop_pool()
+		server.close()
+		os.unlink(path)
+
+def submit(path, argv):
+	''' runs the test suite with the arguments argv in the daemon listening
+	on path, and returns the exit code of the run '''
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		client.connect(path)
+	except socket.error, e:
+		print "unable to connect to the daemon on", path, ":", e
+		return 1
+	client.sendall(json.dumps({"cwd": os.getcwd(), "argv": argv}) + "\n")
+	output = client.makefile('r')
+	code = 1
+	for line in iter(output.readline, ''):
+		if line.startswith(exit_marker):
+			code = int(line[len(exit_marker):])
+			break
+		sys.stdout.write(line)
+	output.close()
+	client.close()
+	return code
+
+def main():
+	path = default_socket
+	optlist, args = getopt.gnu_getopt(sys.argv[1:], 'hs:')
+	for opt, arg in optlist:
+		if opt == '-h':
+			help(sys.argv)
+			sys.exit(0)
+		elif opt == '-s':
+			path = arg
+
+	if not os.path.exists("/dev/uhid"):
+		print "It is required to load the uhid kernel module."
+		sys.exit(1)
+
+	try:
+		serve(path)
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	# disable stdout buffering
+	sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+	main()
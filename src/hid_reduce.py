@@ -0,0 +1,245 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Hid test suite / reduction of a failing recording
+#
+# Copyright (c) 2012-2013 Benjamin Tissoires <benjamin.tissoires@gmail.com>
+# Copyright (c) 2012-2013 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import getopt
+import tempfile
+import threading
+import compare_evemu
+import testsuite
+from hid_test import HIDTest, read_hid_recording, write_hid_recording
+from database import HIDTestDatabase
+
+def help(argv):
+	print argv[0], "[OPTION] DATABASE HID_FILE\n"\
+"""Replays subsets of the reports of the failing recording HID_FILE until
+finding a minimal one which still produces frames that are not in the
+expected outputs of the database DATABASE (delta debugging).
+Where:
+ * OPTION is:
+	-h	print the help message.
+	-jN	replay N subsets in parallel (default: 4).
+	-kKVER	overwrite the current kernel version.
+	-gGAP	shorten the delays between two reports to GAP seconds at most.
+	-oFILE	write the reduced recording in FILE (default: NAME.reduced.hid).
+The failures made only of missing frames can not be reduced."""
+
+def non_extra_keys(outs):
+	''' returns the set of the frames of the captures outs, made of the
+	events really sent by the kernel '''
+	keys = set()
+	for out in outs:
+		out.seek(0)
+		evemu = compare_evemu.EvemuFile(out)
+		for time, n, frame in evemu.frames:
+			keys.add(compare_evemu.frame_key([e for e in frame if not e.extra]))
+	return keys
+
+class Reducer(object):
+	def __init__(self, path, expected, jobs):
+		self.path = path
+		self.jobs = jobs
+		recording = read_hid_recording(path)
+		if not recording:
+			raise ValueError(path + ": the recordings of several devices are not supported")
+		self.descr, self.events = recording
+		# subset (tuple of indexes of events) -> still failing
+		self.cache = {}
+		self.lock = threading.Lock()
+		self.expected_keys = set()
+		for exp in expected:
+			f = compare_evemu.open_recording(exp)
+			self.expected_keys |= non_extra_keys([f])
+			f.close()
+		self.bad_keys = None
+
+	def replay(self, subset):
+		''' replays the events subset and returns the frames keys of the
+		captures '''
+		fd, path = tempfile.mkstemp(suffix = ".hid")
+		output = os.fdopen(fd, 'w')
+		write_hid_recording(output, self.descr, [self.events[i] for i in subset])
+		output.close()
+		test = HIDTest(path)
+		try:
+			test.run_test()
+			return non_extra_keys(test.outs)
+		finally:
+			test.close()
+			os.remove(path)
+
+	def fails(self, subset):
+		''' the recording still fails if one of the unexpected frames of the
+		whole recording shows up '''
+		keys = self.replay(subset)
+		return len(keys & self.bad_keys) > 0
+
+	def test(self, subsets):
+		''' returns the results of the subsets, replaying the ones which are
+		not in the cache in parallel '''
+		todo = [s for s in subsets if not self.cache.has_key(s)]
+		todo = list(set(todo))
+		# exc_info of the first replay which raised
+		errors = []
+		def worker():
+			while True:
+				self.lock.acquire()
+				if not todo:
+					self.lock.release()
+					return
+				subset = todo.pop()
+				self.lock.release()
+				try:
+					r = self.fails(subset)
+				except:
+					self.lock.acquire()
+					errors.append(sys.exc_info())
+					# abort the others as soon as their replay is over
+					del todo[:]
+					self.lock.release()
+					return
+				self.lock.acquire()
+				self.cache[subset] = r
+				self.lock.release()
+
+		threads = [threading.Thread(target=worker) for i in xrange(min(self.jobs, len(todo)))]
+		for t in threads:
+			t.daemon = True
+			t.start()
+		for t in threads:
+			while t.isAlive():
+				t.join(1)
+		if errors:
+			type, value, traceback = errors[0]
+			raise type, value, traceback
+		return [self.cache[s] for s in subsets]
+
+	def reduce(self):
+		''' ddmin over the events of the recording, returns the indexes of the
+		minimal failing subset, or None if the failure can not be reduced '''
+		items = tuple(xrange(len(self.events)))
+		keys = self.replay(items)
+		self.bad_keys = keys - self.expected_keys
+		if not self.bad_keys:
+			return None
+		self.cache[items] = True
+
+		n = 2
+		while len(items) >= 2:
+			size = len(items) / n
+			chunks = [items[i * size:(i + 1) * size] for i in xrange(n - 1)]
+			chunks.append(items[(n - 1) * size:])
+			complements = []
+			for chunk in chunks:
+				removed = set(chunk)
+				complements.append(tuple([i for i in items if i not in removed]))
+
+			# the chunks and their complements are replayed together
+			results = self.test(chunks + complements)
+			print len(items), "events, tested", len(chunks + complements), "subsets"
+			reduced = False
+			for i in xrange(n):
+				if results[i]:
+					items = chunks[i]
+					n = 2
+					reduced = True
+					break
+			if not reduced:
+				for i in xrange(n):
+					if results[n + i]:
+						items = complements[i]
+						n = max(n - 1, 2)
+						reduced = True
+						break
+			if reduced:
+				continue
+			if n >= len(items):
+				break
+			n = min(len(items), n * 2)
+		return items
+
+def main():
+	jobs = 4
+	kernel_release = os.uname()[2]
+	output = None
+	optlist, args = getopt.gnu_getopt(sys.argv[1:], 'hj:k:g:o:')
+	for opt, arg in optlist:
+		if opt == '-h':
+			help(sys.argv)
+			sys.exit(0)
+		elif opt == '-j':
+			jobs = max(1, int(arg))
+		elif opt == '-k':
+			kernel_release = arg
+		elif opt == '-g':
+			HIDTest.max_gap = float(arg)
+		elif opt == '-o':
+			output = arg
+
+	if len(args) != 2:
+		help(sys.argv)
+		sys.exit(1)
+
+	rootdir, path = args
+	if not output:
+		output = os.path.splitext(os.path.basename(path))[0] + ".reduced.hid"
+
+	if not os.path.exists("/dev/uhid"):
+		print "It is required to load the uhid kernel module."
+		sys.exit(1)
+
+	database = HIDTestDatabase(rootdir, kernel_release)
+	if not database.has_key(path):
+		database.append_hid_file(path)
+	expected = database.get_expected(path)
+	if not expected:
+		print "no expected outputs for", path
+		sys.exit(1)
+
+	try:
+		reducer = Reducer(path, expected, jobs)
+	except ValueError, e:
+		print e
+		sys.exit(1)
+
+	HIDTest.use_uhid = True
+	testsuite.start_udev_observer()
+	testsuite.start_xi2detach()
+	try:
+		items = reducer.reduce()
+	finally:
+		testsuite.stop_xi2detach()
+
+	if items == None:
+		print path, "doesn't produce unexpected frames, nothing to reduce."
+		sys.exit(1)
+
+	f = open(output, 'w')
+	write_hid_recording(f, reducer.descr, [reducer.events[i] for i in items])
+	f.close()
+	print "reduced", path, "from", len(reducer.events), "to", len(items), "events in", output, "(" + str(len(reducer.cache)), "replays)"
+
+if __name__ == "__main__":
+	# disable stdout buffering
+	sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+	main()
@@ -25,7 +25,13 @@ import os
 import subprocess
 import shlex
 import threading
+import tempfile
+import shutil
+import cStringIO
+import mmap
 import compare_evemu
+import uhid
+from database import format_kernel_release, resolve_path
 
 hid_replay_path = "/usr/bin"
 hid_replay_cmd = "hid-replay"
@@ -36,7 +42,202 @@ global_lock = threading.Lock()
 
 raw_length = 78
 
+sched_policies = ("nice", "fifo", "rr")
+
+def parse_priority(priority):
+	''' "nice:N", "fifo:N" or "rr:N" -> (policy, N) '''
+	policy, value = priority.split(':')
+	if policy not in sched_policies:
+		raise ValueError(priority)
+	return policy, int(value)
+
+def sched_prefix(cpus = None, priority = None):
+	''' returns the command line prefix that runs a process on the given
+	cpus (taskset list) with the given priority '''
+	prefix = ""
+	if cpus:
+		prefix += "taskset -c " + cpus + " "
+	if priority:
+		policy, value = parse_priority(priority)
+		if policy == "nice":
+			prefix += "nice -n %d " % value
+		else:
+			prefix += "chrt --%s %d " % (policy, value)
+	return prefix
+
+def renice_threads(niceness, devnull):
+	''' sets the niceness of every thread of the current process, os.nice()
+	only changes the calling one '''
+	tids = os.listdir("/proc/self/task")
+	subprocess.call(["renice", str(niceness), "-p"] + tids, stdout=devnull)
+
+def sched_self(cpus = None, priority = None):
+	''' applies the cpus and the priority to the current process and all
+	its threads '''
+	pid = str(os.getpid())
+	devnull = open(os.devnull, 'w')
+	if cpus:
+		subprocess.call(shlex.split("taskset -a -p -c " + cpus + " " + pid), stdout=devnull)
+	if priority:
+		policy, value = parse_priority(priority)
+		if policy == "nice":
+			renice_threads(os.nice(0) + value, devnull)
+		else:
+			subprocess.call(shlex.split("chrt -a --%s -p %d %s" % (policy, value, pid)), stdout=devnull)
+	devnull.close()
+
+def sched_state():
+	''' returns the cpus (taskset list), the niceness and the policy and
+	priority of the current process, to be given to sched_restore() '''
+	cpus = None
+	status = open("/proc/self/status", 'r')
+	for line in status:
+		if line.startswith("Cpus_allowed_list:"):
+			cpus = line.split(':', 1)[1].strip()
+	status.close()
+	policy = "other"
+	value = 0
+	chrt = subprocess.Popen(["chrt", "-p", str(os.getpid())], stdout=subprocess.PIPE)
+	for line in chrt.stdout:
+		field = line.split(': ', 1)[-1].strip()
+		if "policy" in line:
+			# e.g. "SCHED_OTHER|SCHED_RESET_ON_FORK"
+			policy = field.split('|')[0].lower().replace("sched_", "")
+		elif "priority" in line:
+			value = int(field)
+	chrt.wait()
+	return cpus, os.nice(0), policy, value
+
+def sched_restore(state):
+	''' restores the scheduling of the current process and all its threads
+	returned by sched_state() '''
+	cpus, niceness, policy, value = state
+	pid = str(os.getpid())
+	devnull = open(os.devnull, 'w')
+	if cpus:
+		subprocess.call(shlex.split("taskset -a -p -c " + cpus + " " + pid), stdout=devnull)
+	subprocess.call(shlex.split("chrt -a --%s -p %d %s" % (policy, value, pid)), stdout=devnull)
+	renice_threads(niceness, devnull)
+	devnull.close()
+
+class CaptureBuffer(object):
+	''' output of evemu-describe and evemu-record for one event node. The
+	data is kept in memory up to max_size bytes, and spilled in a temporary
+	file past that. Once the capture is over, the buffer can be read as a
+	file. '''
+	default_max_size = 16 << 20
+	max_size = default_max_size
+
+	def __init__(self):
+		self.name = None
+		self.chunks = []
+		self.size = 0
+		self.spill = None
+		self.file = None
+		self.process = None
+		self.reader = None
+
+	def write(self, data):
+		if self.spill:
+			self.spill.write(data)
+		elif self.size + len(data) > CaptureBuffer.max_size:
+			self.spill = os.tmpfile()
+			self.spill.write(''.join(self.chunks))
+			self.spill.write(data)
+			self.chunks = []
+		else:
+			self.chunks.append(data)
+		self.size += len(data)
+
+	def describe(self, dev_path):
+		''' runs evemu-describe, returns False if the device is gone '''
+		p = subprocess.Popen(shlex.split("evemu-describe " + dev_path), stdout=subprocess.PIPE)
+		description = p.communicate()[0]
+		if p.returncode:
+			return False
+
+		# get the name of the node now, the capture doesn't need to be
+		# re-read later
+		for l in description.splitlines():
+			if "Input device name" in l:
+				self.name = l.split("Input device name: ", 1)[1].strip('"')
+				break
+			if l.startswith("N: ") and not self.name:
+				self.name = l[3:]
+
+		# FIXME: check evemu > 1.1, but as there is no release with 1.0...
+		# earlier evemu drop the description in evemu-record too
+		if not description.startswith("# EVEMU"):
+			self.write(description)
+		return True
+
+	def __read_events(self):
+		fd = self.process.stdout.fileno()
+		for data in iter(lambda: os.read(fd, 1 << 16), ''):
+			self.write(data)
+
+	def record(self, dev_path):
+		''' starts evemu-record in the background '''
+		self.process = subprocess.Popen(shlex.split(HIDTest.capture_sched + "evemu-record " + dev_path), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+		self.reader = threading.Thread(target=self.__read_events)
+		self.reader.daemon = True
+		self.reader.start()
+
+	def wait(self):
+		''' waits for evemu-record to terminate, the buffer can then be read '''
+		if self.process:
+			self.process.wait()
+			self.reader.join()
+			self.process = None
+		if self.spill:
+			self.spill.flush()
+			self.file = self.spill
+			self.file.seek(0)
+		else:
+			# cStringIO doesn't copy the data when reading a string
+			self.file = cStringIO.StringIO(''.join(self.chunks))
+			self.chunks = []
+
+	def view(self):
+		''' returns the whole capture, without copying it. The view has to
+		be given back to release() once used. '''
+		if self.spill:
+			if not self.size:
+				return ''
+			return mmap.mmap(self.spill.fileno(), 0, access=mmap.ACCESS_READ)
+		return self.file.getvalue()
+
+	def release(self, view):
+		''' unmaps a view of a spilled capture '''
+		if isinstance(view, mmap.mmap):
+			view.close()
+
+	def seek(self, offset, whence = 0):
+		self.file.seek(offset, whence)
+
+	def tell(self):
+		return self.file.tell()
+
+	def read(self, size = -1):
+		return self.file.read(size)
+
+	def readline(self):
+		return self.file.readline()
+
+	def readlines(self):
+		return self.file.readlines()
+
+	def close(self):
+		if self.file:
+			self.file.close()
+		self.file = None
+		self.spill = None
+		self.chunks = []
+
 class HIDBase(object):
+	# seconds between the start of the replay and the first input node
+	create_time = None
+
 	def dump_outs(self):
 		return []
 	def close(self):
@@ -45,6 +246,22 @@ class HIDBase(object):
 class HIDTest(HIDBase):
 	running = True
 
+	# commands prefixes setting the cpus and the priority of the
+	# processes, see sched_prefix()
+	replay_sched = ""
+	capture_sched = ""
+
+	# replay the recordings in the current process instead of hid-replay
+	use_uhid = False
+
+	# replay the recordings faster: maximum delay between two reports
+	# in seconds, and speed factor
+	max_gap = None
+	speed = 1.0
+
+	# compression suffix of the dumped captures (".gz", ".xz", ".zst")
+	outs_suffix = ""
+
 	instances = []
 	current = None
 	uhid_mappings = {}
@@ -53,11 +270,14 @@ class HIDTest(HIDBase):
 	def __init__(self, path):
 		self.path = path
 		self.condition = threading.Condition()
+		# the delays of the recording have already been shortened
+		self.compressed = False
 
 		self.reset()
 
 	def reset(self):
 		self.hid_replay = None
+		self.replay_file = None
 		self.nodes = {}
 		self.nodes_ready = []
 		self.cv = threading.Condition()
@@ -70,12 +290,15 @@ class HIDTest(HIDBase):
 		outfiles = []
 		for i in xrange(len(self.outs)):
 			out = self.outs[i]
-			out.seek(0)
-			ev_name = hid_name + '_' + str(i) + ".ev"
+			ev_name = hid_name + '_' + str(i) + ".ev" + HIDTest.outs_suffix
 			outfiles.append(ev_name)
-			expected = open(ev_name, 'w')
-			for l in out.readlines():
-				expected.write(l)
+			expected = compare_evemu.create_recording(ev_name)
+			view = out.view()
+			try:
+				expected.write(view)
+			finally:
+				out.release(view)
+			expected.close()
 		return outfiles
 
 	def terminate(self):
@@ -114,30 +337,19 @@ class HIDTest(HIDBase):
 	def __event_udev_event(self, action, device):
 #		print action, device, device.sys_name
 		if action == 'add':
-			tmp = os.tmpfile()
+			capture = CaptureBuffer()
 
 			# get node attributes
 			dev_path = "/dev/input/" + device.sys_name.encode('ascii')
-			if subprocess.call(shlex.split("evemu-describe " + dev_path), stdout=tmp):
+			if not capture.describe(dev_path):
 				# the device has already been unplugged
 				return
 
-			prev_pos = tmp.tell()
-			tmp.seek(0)
-			first_line = tmp.readline()
-			if first_line.startswith("# EVEMU"):
-				# FIXME: check evemu > 1.1, but as there is no release with 1.0...
-				# earlier evemu drop the description in evemu-record too
-				tmp.close()
-				tmp = os.tmpfile()
-			else:
-				tmp.seek(prev_pos)
-
 			# start capturing events
-			p = subprocess.Popen(shlex.split("evemu-record " + dev_path), stderr=subprocess.PIPE, stdout=tmp)
+			capture.record(dev_path)
 
 			# store it for later
-			self.nodes[device.sys_name] = tmp, p
+			self.nodes[device.sys_name] = capture
 
 			# notify the current hid test that one device has been added
 			self.condition.acquire()
@@ -148,28 +360,17 @@ class HIDTest(HIDBase):
 		elif action == 'remove':
 			# get corresponding capturing process in background
 			try:
-				result, p = self.nodes[device.sys_name]
+				capture = self.nodes[device.sys_name]
 			except KeyError:
 				# not a registered device => we don't care
 				return
 
-			# wait for it to terminate
-			p.wait()
-
-			# get the name of the node
-			result.seek(0)
-			name = None
-			for l in result.readlines():
-				if "Input device name" in l:
-					name = l.replace("Input device name: \"", '')[:-2]
-					break
-
-			# reset the output so that it can be re-read later
-			result.seek(0)
+			# wait for it to terminate, the capture can then be read
+			capture.wait()
 
 			# notify test_hid that we are done with the capture of this node
 			self.cv.acquire()
-			self.nodes_ready.append((device.sys_name, name, result))
+			self.nodes_ready.append((device.sys_name, capture.name, capture))
 			del self.nodes[device.sys_name]
 			self.cv.notify()
 			self.cv.release()
@@ -177,6 +378,42 @@ class HIDTest(HIDBase):
 	def print_launch(self):
 		print "launching test", self.path
 
+	def start_replay(self):
+		max_gap = HIDTest.max_gap
+		speed = HIDTest.speed
+		if self.compressed:
+			max_gap = None
+			speed = 1.0
+		if HIDTest.use_uhid:
+			try:
+				return uhid.UHIDReplay(resolve_path(self.path), max_gap = max_gap, speed = speed)
+			except (ValueError, OSError), e:
+				print "unable to replay", self.path, "in-process (" + str(e) + "), using", hid_replay_cmd
+		path = resolve_path(self.path)
+		compressed = compare_evemu.compression_suffix(path)
+		if max_gap != None or speed != 1.0:
+			recording = read_hid_recording(path)
+			if recording:
+				descr, events = recording
+				fd, path = tempfile.mkstemp(suffix = ".hid")
+				output = os.fdopen(fd, 'w')
+				write_hid_recording(output, descr, uhid.compress_delays(events, max_gap, speed))
+				output.close()
+				self.replay_file = path
+				compressed = None
+			else:
+				print "unable to shorten the delays of", self.path, ", replaying it at its pace"
+		if compressed:
+			# hid-replay only reads plain files
+			fd, self.replay_file = tempfile.mkstemp(suffix = ".hid")
+			output = os.fdopen(fd, 'w')
+			recording = compare_evemu.open_recording(path)
+			shutil.copyfileobj(recording, output)
+			recording.close()
+			output.close()
+			path = self.replay_file
+		return subprocess.Popen(shlex.split(HIDTest.replay_sched + hid_replay + " -s 1 -1 " + path))
+
 	def run_test(self):
 		self.reset()
 		# acquire the lock so that only this test will get the udev 'add' notifications
@@ -191,7 +428,8 @@ class HIDTest(HIDBase):
 		HIDTest.current = self
 
 		self.print_launch()
-		self.hid_replay = subprocess.Popen(shlex.split(hid_replay + " -s 1 -1 " + self.path))
+		start = time.time()
+		self.hid_replay = self.start_replay()
 
 		# wait for one input node to be created
 		self.condition.acquire()
@@ -199,6 +437,7 @@ class HIDTest(HIDBase):
 			self.condition.wait()
 		self.condition_op = False
 		self.condition.release()
+		self.create_time = time.time() - start
 
 		# wait 1 more second before releasing the lock, in case others
 		# devices appear
@@ -207,7 +446,11 @@ class HIDTest(HIDBase):
 		# now other tests can be launched
 		global_lock.release()
 
-		if self.hid_replay.wait():
+		returncode = self.hid_replay.wait()
+		if self.replay_file:
+			os.remove(self.replay_file)
+			self.replay_file = None
+		if returncode:
 			return -1
 
 		self.hid_replay = None
@@ -241,6 +484,22 @@ class HIDTest(HIDBase):
 		return 0
 
 class Compare(object):
+	# report all the differing frames instead of the first one
+	align = False
+	# dict percentile -> maximum jitter allowed between frames
+	timing_limits = None
+	# HIDTestDatabase with the results of a previous run
+	timing_baseline = None
+	# the delays between the reports have been changed on purpose
+	ignore_timings = False
+	# also compare the captures against the expected outputs of all the
+	# kernel series, with matrix_jobs processes
+	matrix = False
+	matrix_jobs = 1
+	# measure the performance of the tests, and compare it to the one of
+	# the nearest earlier kernel series of the database
+	perf_tracking = False
+
 	def __init__(self, path, expected, results, result_database, delta_timestamp, hid_base):
 		self.delta_timestamp = delta_timestamp
 		self.result_database = result_database
@@ -248,6 +507,7 @@ class Compare(object):
 		self.outs = results
 		self.path = path
 		self.hid_base = hid_base
+		self.timings = []
 
 	def dump_outs(self):
 		return self.hid_base.dump_outs()
@@ -264,18 +524,143 @@ class Compare(object):
 		for i in xrange(len(self.expected)):
 			ev_name = hid_name + '_exp_' + str(i) + ".evd"
 			outfiles.append(ev_name)
-			expect = open(self.expected[i], 'r')
+			expect = compare_evemu.open_recording(self.expected[i])
 			compare_evemu.dump_diff(ev_name, expect)
 			expect.close()
 		return outfiles
 
 	def compare_result(self, str_result):
-		return compare_evemu.compare_sets(self.expected, self.outs, str_result, self.delta_timestamp)
+		self.timings = []
+		timings = self.timings
+		if Compare.ignore_timings:
+			timings = None
+		r, w = compare_evemu.compare_sets(self.expected, self.outs, str_result, self.delta_timestamp, Compare.align, timings)
+		if r and self.check_timings(str_result):
+			w = True
+		return r, w
+
+	def check_matrix(self, str_result):
+		''' reports the kernel series whose expected outputs match the
+		captures '''
+		variants = self.result_database.get_kernel_variants(self.path)
+		if not variants:
+			return
+		results = compare_evemu.compare_variants([paths for releases, paths in variants], self.outs, Compare.matrix_jobs)
+
+		# ranges of consecutive series with the same result
+		ranges = []
+		for i in xrange(len(variants)):
+			r = results[i][0]
+			for release in variants[i][0]:
+				if ranges and ranges[-1][0] == r and release != None and ranges[-1][2] != None:
+					ranges[-1][2] = release
+				else:
+					ranges.append([r, release, release])
+
+		matching = []
+		differing = []
+		for r, first, last in ranges:
+			if first == None:
+				name = "unversioned"
+			elif first == last:
+				name = format_kernel_release(first)
+			else:
+				name = format_kernel_release(first) + "-" + format_kernel_release(last)
+			if r:
+				matching.append(name)
+			else:
+				differing.append(name)
+		str_result.append("kernels matching: " + (', '.join(matching) or "none"))
+		if differing:
+			str_result.append("kernels differing: " + ', '.join(differing))
+
+	def check_timings(self, str_result):
+		''' returns True if the timings exceed the limits or regressed '''
+		warning = False
+		# output index -> TimingStats, the results of older versions only
+		# have the timings of the matching outputs, in order
+		baseline = {}
+		if Compare.timing_baseline:
+			baseline_timings = Compare.timing_baseline.get_timings(self.path)
+			for i in xrange(len(baseline_timings)):
+				output = baseline_timings[i].output
+				if output == None:
+					output = i
+				baseline[output] = baseline_timings[i]
+		for stats in self.timings:
+			prefix = 'output #' + str(stats.output) + ': '
+			if len(self.outs) == 1:
+				prefix = ''
+			if Compare.timing_limits:
+				exceeded = stats.exceeded_limits(Compare.timing_limits)
+				if exceeded:
+					str_result.append(prefix + 'timings: ' + str(stats) + ', exceeding the limits of ' + ', '.join(exceeded))
+					warning = True
+			if baseline.has_key(stats.output):
+				for p in stats.regressions(baseline[stats.output]):
+					str_result.append(prefix + 'timings: %s regressed from %f to %f' % (p, getattr(baseline[stats.output], p), getattr(stats, p)))
+					warning = True
+		return warning
+
+	def check_perf(self, str_result):
+		''' appends the performance of the test to the runs of the current
+		kernel series in NAME.perf in the current directory, and returns True
+		if these runs are significantly worse than the baseline of the
+		database '''
+		if self.hid_base.create_time == None:
+			# the recording has not been replayed
+			return False
+		count, first, last = 0, None, None
+		for out in self.outs:
+			view = out.view()
+			try:
+				n, f, l = compare_evemu.count_events(view)
+			finally:
+				out.release(view)
+			if not n:
+				continue
+			count += n
+			if first == None or f < first:
+				first = f
+			last = max(last, l)
+		rate = None
+		if count and last > first:
+			rate = count / (last - first)
+		jitter = None
+		if self.timings:
+			jitter = max([stats.p95 for stats in self.timings])
+
+		perf = compare_evemu.PerfStats()
+		perf.add_run(self.hid_base.create_time, rate, jitter)
+		str_result.append("performance: " + str(perf))
+
+		# the runs on the same kernel series are accumulated
+		kernel = format_kernel_release(self.result_database.kernel_release)
+		perf_name = os.path.splitext(os.path.basename(self.path))[0] + ".perf"
+		runs = compare_evemu.PerfStats.read(perf_name)
+		if runs.kernel_release != kernel:
+			runs = compare_evemu.PerfStats(kernel)
+		runs.add_run(self.hid_base.create_time, rate, jitter)
+		runs.write(perf_name)
+
+		baseline = self.result_database.get_perf_baseline(self.path)
+		if not baseline:
+			return False
+		kernel_release, path = baseline
+		baseline = compare_evemu.PerfStats.read(path)
+		if len(baseline.runs) < 2 or len(runs.runs) < 2:
+			str_result.append("performance: %d runs on %s and %d on %s, 2 are needed to compare" % (len(runs.runs), kernel, len(baseline.runs), format_kernel_release(kernel_release)))
+			return False
+		slowdowns = runs.slowdowns(baseline)
+		for metric, before, after, p in slowdowns:
+			str_result.append("performance: %s regressed from %f to %f since %s (p = %.2g, %d runs)" % (metric, before, after, format_kernel_release(kernel_release), p, len(runs.runs)))
+		return len(slowdowns) > 0
 
 	def append_result(self, str_result, result, warning):
 		global_lock.acquire()
 		# append the result of the test to the list,
 		self.result_database.append_result(self.path, result, warning)
+		self.result_database.append_timings(self.path, self.timings)
 
 		str_result.append(self.result_database.get_results_count())
 		str_result.append("-" * raw_length)
@@ -283,16 +668,26 @@ class Compare(object):
 		print '\n'.join(str_result)
 		global_lock.release()
 
-	def run(self):
+	def title(self):
 		basename = os.path.basename(self.path)
 		name_length = len(basename) + 2
 		prev = (raw_length - name_length) / 2
 		after = raw_length - name_length - prev
-		str_result = [("-"*prev) + " " + basename + " " + ("-"*after)]
+		return ("-"*prev) + " " + basename + " " + ("-"*after)
+
+	def run(self):
+		str_result = [self.title()]
 
 		# compare them
 		r, w = self.compare_result(str_result)
-
+		# the performance of a failing test is not recorded
+		if r and Compare.perf_tracking and self.check_perf(str_result):
+			w = True
+		if Compare.matrix:
+			self.check_matrix(str_result)
+		return self.report(str_result, r, w)
+
+	def report(self, str_result, r, w):
 		if not r:
 			# if there is a change, then dump the captures in the current directory
 			str_result.append("test failed, dumping outputs in:")
@@ -330,13 +725,220 @@ class HIDTestAndCompare(HIDTest):
 		self.run_test()
 		return Compare(self.path, self.expected, self.outs, self.result_database, self.delta_timestamp, self).run()
 
+def read_hid_recording(path):
+	''' returns the description lines and the events (time, data) of a .hid
+	recording, or None if it contains several devices '''
+	descr = []
+	events = []
+	f = compare_evemu.open_recording(resolve_path(path))
+	for line in f:
+		if line.startswith("E: "):
+			t, data = line[3:].split(' ', 1)
+			events.append((float(t), data))
+		elif line.startswith("D: "):
+			f.close()
+			return None
+		elif line.strip() and not line.startswith('#'):
+			descr.append(line)
+	f.close()
+	return descr, events
+
+def read_hid_description(path):
+	''' returns the description lines of a .hid recording, read up to its
+	first event, or None if it contains several devices or no events '''
+	descr = []
+	f = compare_evemu.open_recording(resolve_path(path))
+	for line in f:
+		if line.startswith("E: "):
+			f.close()
+			return descr
+		elif line.startswith("D: "):
+			break
+		elif line.strip() and not line.startswith('#'):
+			descr.append(line)
+	f.close()
+	return None
+
+def write_hid_recording(output, descr, events):
+	''' writes the description lines and the events (time, data) in output
+	in the format of hid-recorder '''
+	output.write(''.join(descr))
+	for t, data in events:
+		usec = int(round(t * 1000000))
+		output.write("E: %06d.%06d %s" % (usec / 1000000, usec % 1000000, data))
+
+def group_recordings(paths):
+	''' groups the .hid recordings having the same device description, in
+	the order of the list '''
+	groups = {}
+	order = []
+	for path in paths:
+		key = path
+		descr = read_hid_description(path)
+		if descr:
+			key = tuple(descr)
+		if not groups.has_key(key):
+			groups[key] = []
+			order.append(key)
+		groups[key].append(path)
+	return [groups[key] for key in order]
+
+def renumber_tracking_ids(segments):
+	''' the kernel doesn't restart the tracking ids of a device: make the
+	ones of each segment of a capture start from 0 as with a new device '''
+	allocated = 0
+	for segment in segments:
+		new_ids = []
+		for i in xrange(len(segment)):
+			if not "0039" in segment[i]:
+				continue
+			fields = segment[i].split()
+			if len(fields) > 4 and fields[0] == "E:" and int(fields[2], 16) == 0x03 and int(fields[3], 16) == 0x39 and int(fields[4]) != -1:
+				new_ids.append((i, fields))
+		# only renumber the ids given by the input core, not the ones
+		# reported by the device
+		if new_ids and allocated and int(new_ids[0][1][4]) == allocated & 0xffff:
+			for i, fields in new_ids:
+				value = (int(fields[4]) - allocated) & 0xffff
+				segment[i] = "E: %s %s %s %04d\n" % (fields[1], fields[2], fields[3], value)
+		allocated += len(new_ids)
+
+class HIDBulkSegment(HIDTest):
+	''' the captures of one recording of a bulk replay '''
+	def __init__(self, path, outs):
+		self.path = path
+		self.outs = outs
+
+class BulkCompare(Compare):
+	''' failures are not recorded: the recording has to be replayed on its
+	own to know whether it fails '''
+	def compare_result(self, str_result):
+		# the delays between the recordings have been shortened, the
+		# timings are meaningless
+		self.timings = []
+		return compare_evemu.compare_sets(self.expected, self.outs, str_result, self.delta_timestamp, Compare.align)
+
+	def run(self):
+		str_result = [self.title()]
+		r, w = self.compare_result(str_result)
+		if not r:
+			self.hid_base.close()
+			return False
+		if Compare.matrix:
+			self.check_matrix(str_result)
+		self.report(str_result, r, w)
+		return True
+
+class HIDBulkTest(HIDTest):
+	''' replays several recordings of the same device through one uhid
+	device. The recordings are separated by bulk_gap seconds and the
+	captures are split at these gaps. The recordings which don't pass are
+	replayed again on their own. '''
+	# seconds between two recordings, the delays inside a recording are
+	# reduced to a quarter of it
+	bulk_gap = 2.0
+
+	def __init__(self, paths, result_database, delta_timestamp):
+		super(HIDBulkTest, self).__init__(None)
+		self.paths = paths
+		self.result_database = result_database
+		self.delta_timestamp = delta_timestamp
+
+	def print_launch(self):
+		print "launching", len(self.paths), "tests in bulk:", ' '.join(self.paths)
+
+	def write_recording(self):
+		''' concatenates the recordings in a temporary .hid file '''
+		max_delay = HIDBulkTest.bulk_gap / 4
+		if HIDTest.max_gap != None:
+			max_delay = min(max_delay, HIDTest.max_gap)
+		descr = []
+		events = []
+		for path in self.paths:
+			recording = read_hid_recording(path)
+			start = 0.0
+			if events:
+				start = events[-1][0] + HIDBulkTest.bulk_gap
+			else:
+				descr = recording[0]
+			events.extend(uhid.compress_delays(recording[1], max_delay, HIDTest.speed, start))
+		fd, path = tempfile.mkstemp(suffix = ".hid")
+		output = os.fdopen(fd, 'w')
+		write_hid_recording(output, descr, events)
+		output.close()
+		self.compressed = True
+		return path
+
+	def split_capture(self, capture):
+		''' splits the capture of one node at the gaps between the
+		recordings, returns one CaptureBuffer per recording or None '''
+		capture.seek(0)
+		header = []
+		segments = []
+		prev = None
+		for line in iter(capture.readline, ''):
+			if not line.startswith("E: "):
+				if segments:
+					segments[-1].append(line)
+				else:
+					header.append(line)
+				continue
+			t = float(line.split(' ', 2)[1])
+			if prev == None or t - prev >= HIDBulkTest.bulk_gap / 2:
+				segments.append([])
+			segments[-1].append(line)
+			prev = t
+
+		if not segments:
+			# nothing happened on this node
+			segments = [[] for path in self.paths]
+		if len(segments) != len(self.paths):
+			return None
+
+		renumber_tracking_ids(segments)
+		header = ''.join(header)
+		buffers = []
+		for segment in segments:
+			buffer = CaptureBuffer()
+			buffer.name = capture.name
+			buffer.write(header)
+			buffer.write(''.join(segment))
+			buffer.wait()
+			buffers.append(buffer)
+		return buffers
+
+	def run(self):
+		self.path = self.write_recording()
+		try:
+			self.run_test()
+		finally:
+			os.remove(self.path)
+			self.path = None
+
+		splits = [self.split_capture(out) for out in self.outs]
+		self.close()
+		if not splits or None in splits:
+			splits = None
+
+		for i in xrange(len(self.paths)):
+			path = self.paths[i]
+			expected = self.result_database.get_expected(path)
+			if splits:
+				outs = [buffers[i] for buffers in splits]
+				if BulkCompare(path, expected, outs, self.result_database, self.delta_timestamp, HIDBulkSegment(path, outs)).run():
+					continue
+			# replay the recording on its own to get its real result
+			if HIDTestAndCompare(path, self.result_database, self.delta_timestamp).run() < 0:
+				return -1
+		return 0
+
 class HIDThread(threading.Thread):
 	count = 1
 	sema = None
 	ok = True
 	lock = threading.Lock()
 
-	def __init__(self, file, result_database, delta_timestamp, simple_evemu_mode):
+	def __init__(self, hid):
 		threading.Thread.__init__(self)
 		HIDThread.lock.acquire()
 		if not HIDThread.sema:
@@ -344,10 +946,7 @@ class HIDThread(threading.Thread):
 		HIDThread.lock.release()
 		self.daemon = True
 
-		if simple_evemu_mode:
-			self.hid = HIDTest(file)
-		else:
-			self.hid = HIDTestAndCompare(file, result_database, delta_timestamp)
+		self.hid = hid
 
 	def run(self):
 		HIDThread.sema.acquire()
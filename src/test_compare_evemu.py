@@ -0,0 +1,144 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Hid test suite / tests of compare_evemu.py
+#
+# Copyright (c) 2012-2013 Benjamin Tissoires <benjamin.tissoires@gmail.com>
+# Copyright (c) 2012-2013 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import random
+import tempfile
+import unittest
+import compare_evemu
+from compare_evemu import EvemuFile
+
+header = """# EVEMU 1.2
+N: random multitouch
+I: 0003 0001 0002 0100
+"""
+
+def write_mt_recording(path, seed, frames = 300, slots = 4):
+	''' writes a random recording of a multitouch device with slots slots,
+	the slots being selected, lifted and reused in any order. Without
+	slots, only the single touch axes are sent. '''
+	rand = random.Random(seed)
+	output = open(path, 'w')
+	output.write(header)
+	t = 0.0
+	tracking_id = 0
+	for i in xrange(frames):
+		t += 0.008
+		events = []
+		for j in xrange(rand.randint(0, 3) * (slots > 0)):
+			if rand.random() < 0.4:
+				events.append((3, 0x2f, rand.randint(0, slots - 1)))
+			r = rand.random()
+			if r < 0.1:
+				events.append((3, 0x39, -1))
+			elif r < 0.2:
+				tracking_id += 1
+				events.append((3, 0x39, tracking_id))
+			if rand.random() < 0.6:
+				events.append((3, 0x35, rand.randint(0, 4095)))
+			if rand.random() < 0.3:
+				events.append((3, 0x36, rand.randint(0, 4095)))
+		if rand.random() < 0.1:
+			events.append((3, 0x00, rand.randint(0, 4095)))
+		if rand.random() < 0.05:
+			events.append((1, 0x14a, rand.randint(0, 1)))
+		for type, code, value in events:
+			output.write("E: %.6f %04x %04x %d\n" % (t, type, code, value))
+		output.write("E: %.6f 0000 0000 0000\n" % t)
+	output.close()
+
+def parse(path):
+	f = open(path, 'r')
+	evemu = EvemuFile(f)
+	f.close()
+	# the events of the chunks have the time of their frame
+	frames = [(time, n, [(e.type, e.code, e.value, e.extra) for e in frame]) for time, n, frame in evemu.frames]
+	runs = [i > 0 and evemu.frames[i][2] is evemu.frames[i - 1][2] for i in xrange(len(evemu.frames))]
+	return frames, runs, evemu.hashes, evemu.digest
+
+class ChunkedParseTest(unittest.TestCase):
+	def setUp(self):
+		fd, self.path = tempfile.mkstemp(suffix = ".ev")
+		os.close(fd)
+		self.chunk_size = EvemuFile.chunk_size
+		self.parse_jobs = EvemuFile.parse_jobs
+		compare_evemu.start_pool(4)
+
+	def tearDown(self):
+		compare_evemu.stop_pool()
+		EvemuFile.chunk_size = self.chunk_size
+		EvemuFile.parse_jobs = self.parse_jobs
+		os.remove(self.path)
+
+	def test_same_as_sequential(self):
+		for seed in xrange(150):
+			write_mt_recording(self.path, seed, slots = seed % 10 and 4)
+			EvemuFile.parse_jobs = 1
+			expected = parse(self.path)
+			EvemuFile.chunk_size = 1
+			for jobs in (3, 4):
+				EvemuFile.parse_jobs = jobs
+				self.assertEqual(parse(self.path), expected, "recording %d, %d jobs" % (seed, jobs))
+			EvemuFile.chunk_size = self.chunk_size
+
+class CompareVariantsTest(unittest.TestCase):
+	def setUp(self):
+		self.paths = []
+		for seed in xrange(3):
+			fd, path = tempfile.mkstemp(suffix = ".ev")
+			os.close(fd)
+			write_mt_recording(path, seed % 2)
+			self.paths.append(path)
+		compare_evemu.start_pool(2)
+
+	def tearDown(self):
+		compare_evemu.stop_pool()
+		for path in self.paths:
+			os.remove(path)
+
+	def test_pool_same_as_sequential(self):
+		variants = [[path] for path in self.paths]
+		expected = compare_evemu.compare_variants(variants, self.paths[:1])
+		self.assertEqual([r for r, w, output in expected], [True, False, True])
+		for i in xrange(2):
+			self.assertEqual(compare_evemu.compare_variants(variants, self.paths[:1], 2), expected)
+
+class TimingsTest(unittest.TestCase):
+	def setUp(self):
+		self.paths = []
+		for seed in xrange(2):
+			fd, path = tempfile.mkstemp(suffix = ".ev")
+			os.close(fd)
+			write_mt_recording(path, seed)
+			self.paths.append(path)
+
+	def tearDown(self):
+		for path in self.paths:
+			os.remove(path)
+
+	def test_output_index(self):
+		timings = []
+		compare_evemu.compare_sets(self.paths[:1], self.paths[::-1], [], timings = timings)
+		self.assertEqual([stats.output for stats in timings], [1])
+
+if __name__ == "__main__":
+	unittest.main()
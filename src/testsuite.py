@@ -28,11 +28,19 @@ import subprocess
 import shlex
 import getopt
 import re
+import multiprocessing
 from hid_test import HIDTest, HIDTestAndCompare, HIDThread, HIDBase, Compare
-from database import HIDTestDatabase
+from hid_test import sched_prefix, sched_self, parse_priority, CaptureBuffer
+from hid_test import sched_state, sched_restore
+from hid_test import HIDBulkTest, group_recordings
+from database import HIDTestDatabase, recording_name
+from compare_evemu import TimingStats, EvemuFile, compressed_suffixes
+from compare_evemu import start_pool, stop_pool
 
 context = pyudev.Context()
 
+sched_roles = ("replay", "capture", "compare")
+
 def udev_event(action, device):
 	if ":" in device.sys_name:
 		HIDTest.hid_udev_event(action, device)
@@ -48,7 +56,7 @@ def help(argv):
  * OPTION is:
 	-h	print the help message.
 	-jN	Launch N threads in parallel. This reduce the global time of the tests,
-		but corrupts the timestamps between frames.
+		but corrupts the timestamps between frames (see -c and -p).
 	-kKVER	overwritte the current kernel version
 	-tS	Print a warning if the timestamps between two frames is greater than S.
 		Example: "-t0.01".
@@ -56,9 +64,64 @@ def help(argv):
 	-E	"Evemu mode": Do not compare, just output the evemu outputs in
 		the current directory.
 	-f	"fast mode": if a device already has an expected output from the same
-		kernel series, then skip the test."""
+		kernel series, then skip the test.
+	-sI/N	only run the shard I (from 1 to N) of the list of tests.
+	-wW	weight the shards by the size of the recordings ("size") or by
+		their duration ("duration").
+	-oFILE	write the results in FILE. The results of several shards can be
+		merged with "database.py -m FILE...".
+	-a	"alignment mode": on failure, report all the frames that have been
+		changed, dropped or inserted instead of only the first error, and
+		the mismatching events by type and code.
+	-lLIMITS	raise a warning if the jitter between the expected and the actual
+		delays between frames exceeds the limits. LIMITS is a list of
+		percentile:seconds among p50, p95, p99 and max.
+		Example: "-lp99:0.002,max:0.01".
+	-bFILE	raise a warning if the jitter regressed compared to the results
+		FILE of a previous run (see -o).
+	-cR:CPUS	run the processes of the role R on the CPUS (taskset list).
+		R is "replay" (hid-replay), "capture" (evemu-record) or
+		"compare" (the test suite itself). Example: "-creplay:0 -ccapture:1".
+	-pR:PRIO	run the processes of the role R with the priority PRIO, which
+		is "nice:N", "fifo:N" or "rr:N". Example: "-preplay:fifo:50".
+	-DSOCKET	run the tests in the daemon (hid_daemon.py) listening on SOCKET.
+	-MSIZE	keep up to SIZE MiB of each capture in memory before writing it
+		in a temporary file (default: 16).
+	-B	"bulk mode": replay the recordings of the same device one after the
+		other through one device, and replay again on their own the ones
+		which fail. The delays between events are shortened, so this is
+		not compatible with -t, and the timings are not checked.
+	-U	replay the recordings through /dev/uhid from the test suite itself
+		instead of launching hid-replay (the -c and -p options of the
+		"replay" role then apply to "compare").
+	-gGAP	shorten the delays between two reports of the recordings to GAP
+		seconds at most.
+	-xFACTOR	replay the recordings FACTOR times faster.
+		With -g or -x, the timestamps and the timings are not checked
+		(-t, -l and -b are ignored).
+	-K	"matrix mode": also compare the outputs against the expected ones
+		of every kernel series of the database, and report the matching
+		series (also done for the passing recordings of -B).
+	-zSUFFIX	compress the dumped outputs with gzip ("gz"), xz ("xz") or
+		zstd ("zst").
+	-PN	parse the expected outputs bigger than 32 MiB in N processes.
+	-T	"performance mode": append the device creation time, the events
+		rate and the jitter of each passing test to NAME.perf in the
+		current directory, and raise a warning if the runs of the current
+		kernel series are significantly worse than the ones of the
+		nearest earlier kernel series of the database."""
+
+# set by hid_daemon.py: keep xi2detach and the udev observer between runs
+persistent = False
+xi2detach = None
+observer = None
 
 def start_xi2detach():
+	global xi2detach
+	if xi2detach and xi2detach.poll() == None:
+		# already running
+		return xi2detach
+
 	# starts xi2detach
 	xi2detach = subprocess.Popen(shlex.split(os.path.join(os.path.dirname(sys.argv[0]), 'xi2detach')), stderr= subprocess.PIPE, stdout= subprocess.PIPE)
 
@@ -66,13 +129,57 @@ def start_xi2detach():
 	time.sleep(1)
 	return xi2detach
 
+def stop_xi2detach():
+	global xi2detach
+	if persistent or not xi2detach:
+		return
+	xi2detach.terminate()
+	xi2detach = None
+
+def start_udev_observer():
+	global observer
+	if observer:
+		return observer
+	# create udev notification system
+	monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+	monitor.filter_by('input')
+	monitor.filter_by('hid')
+	observer = pyudev.MonitorObserver(monitor, udev_event)
+	# start monitoring udev events
+	observer.start()
+	return observer
+
+def reset_options():
+	# the options are stored in the classes, restore the defaults in case
+	# of several runs in the same process
+	HIDTest.running = True
+	HIDTest.replay_sched = ""
+	HIDTest.capture_sched = ""
+	HIDTest.use_uhid = False
+	HIDTest.max_gap = None
+	HIDTest.speed = 1.0
+	HIDTest.outs_suffix = ""
+	HIDThread.count = 1
+	HIDThread.sema = None
+	HIDThread.ok = True
+	Compare.align = False
+	Compare.timing_limits = None
+	Compare.timing_baseline = None
+	Compare.ignore_timings = False
+	Compare.matrix = False
+	Compare.matrix_jobs = 1
+	Compare.perf_tracking = False
+	CaptureBuffer.max_size = CaptureBuffer.default_max_size
+	EvemuFile.parse_jobs = 1
+
 def run_check(list_of_ev_files, database, delta_timestamp):
 	# evemu_outputs contains a key matching a hid file, and the results
 	evemu_outputs = {}
 	regex = re.compile("(.*)_[0-9]+\.ev")
 	for ev in list_of_ev_files:
-		key = ev[:-3] + ".hid"
-		m = regex.match(ev)
+		name = recording_name(ev)
+		key = name[:-3] + ".hid"
+		m = regex.match(name)
 		if m:
 			key = m.group(1) + ".hid"
 		if not database.skip_test(key):
@@ -106,33 +213,36 @@ def run_check(list_of_ev_files, database, delta_timestamp):
 		compare = Compare(hid_file, expected, results, database, delta_timestamp, dummy)
 		compare.run()
 
-def run_tests(list_of_hid_files, database, simple_evemu_mode, delta_timestamp):
+def run_tests(list_of_hid_files, database, simple_evemu_mode, delta_timestamp, bulk = False):
 	threads = []
 	database.incr_total_tests_count(len(list_of_hid_files))
-	# create udev notification system
-	monitor = pyudev.Monitor.from_netlink(pyudev.Context())
-	monitor.filter_by('input')
-	monitor.filter_by('hid')
-	observer = pyudev.MonitorObserver(monitor, udev_event)
-	# start monitoring udev events
-	observer.start()
+	start_udev_observer()
 
+	files = []
 	for file in list_of_hid_files:
 		if database.skip_test(file):
 			continue
 		if not database.has_key(file):
 			database.append_hid_file(file)
+		files.append(file)
+
+	groups = [[file] for file in files]
+	if bulk:
+		groups = group_recordings(files)
+
+	for group in groups:
+		if len(group) > 1:
+			hid = HIDBulkTest(group, database, delta_timestamp)
+		elif simple_evemu_mode:
+			hid = HIDTest(group[0])
+		else:
+			hid = HIDTestAndCompare(group[0], database, delta_timestamp)
 		if HIDThread.count > 1:
-			thread = HIDThread(file, database, delta_timestamp, simple_evemu_mode)
+			thread = HIDThread(hid)
 			threads.append(thread)
 			thread.start()
-		else:
-			if simple_evemu_mode:
-				if HIDTest(file).run() < 0:
-					break
-			else:
-				if HIDTestAndCompare(file, database, delta_timestamp).run() < 0:
-					break
+		elif hid.run() < 0:
+			break
 	while len(threads) > 0:
 		try:
 			# Join all threads using a timeout so it doesn't block
@@ -147,19 +257,59 @@ def run_tests(list_of_hid_files, database, simple_evemu_mode, delta_timestamp):
 			for t in threads:
 				t.terminate()
 
-def main():
+def main(argv = None):
+	if argv == None:
+		argv = sys.argv
+	reset_options()
+	daemon_socket = None
 	fast_mode = False
 	simple_evemu_mode = False
+	shard = None
+	shard_weight = None
+	results_file = None
+	sched_cpus = {}
+	sched_priorities = {}
+	bulk = False
 	delta_timestamp = 0
 	kernel_release = os.uname()[2]
-	# disable stdout buffering
-	sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 
-	optlist, args = getopt.gnu_getopt(sys.argv[1:], 'hj:k:t:fdE')
+	optlist, args = getopt.gnu_getopt(argv[1:], 'hj:k:t:fdEs:w:o:al:b:c:p:D:M:BUg:x:Kz:P:T')
 	for opt, arg in optlist:
 		if opt == '-h':
-			help(sys.argv)
+			help(argv)
 			sys.exit(0)
+		elif opt == '-D':
+			daemon_socket = arg
+		elif opt in ('-g', '-x'):
+			try:
+				value = float(arg)
+				if value <= 0:
+					raise ValueError
+			except ValueError:
+				print "invalid value", arg, "for", opt
+				sys.exit(1)
+			if opt == '-g':
+				HIDTest.max_gap = value
+			else:
+				HIDTest.speed = value
+		elif opt == '-z':
+			if "." + arg not in compressed_suffixes:
+				print "invalid compression", arg, "expecting \"gz\", \"xz\" or \"zst\"."
+				sys.exit(1)
+			HIDTest.outs_suffix = "." + arg
+		elif opt == '-P':
+			EvemuFile.parse_jobs = max(1, int(arg))
+		elif opt == '-T':
+			Compare.perf_tracking = True
+		elif opt == '-K':
+			Compare.matrix = True
+			Compare.matrix_jobs = multiprocessing.cpu_count()
+		elif opt == '-U':
+			HIDTest.use_uhid = True
+		elif opt == '-B':
+			bulk = True
+		elif opt == '-M':
+			CaptureBuffer.max_size = int(float(arg) * (1 << 20))
 		elif opt == '-t':
 			delta_timestamp = float(arg)
 		elif opt == '-j':
@@ -175,11 +325,80 @@ def main():
 			fast_mode = True
 		elif opt == '-m':
 			pass
+		elif opt == '-s':
+			try:
+				index, count = [int(i) for i in arg.split('/')]
+			except ValueError:
+				index, count = 0, 0
+			if count < 1 or index < 1 or index > count:
+				print "invalid shard", arg, "expecting I/N with 1 <= I <= N."
+				sys.exit(1)
+			shard = index, count
+		elif opt == '-w':
+			if arg not in ("size", "duration"):
+				print "invalid shard weight", arg, "expecting \"size\" or \"duration\"."
+				sys.exit(1)
+			shard_weight = arg
+		elif opt == '-o':
+			results_file = arg
+		elif opt == '-a':
+			Compare.align = True
+		elif opt == '-l':
+			Compare.timing_limits = {}
+			try:
+				for limit in arg.split(','):
+					percentile, seconds = limit.split(':')
+					if percentile not in TimingStats.percentiles:
+						raise ValueError
+					Compare.timing_limits[percentile] = float(seconds)
+			except ValueError:
+				print "invalid timing limits", arg
+				sys.exit(1)
+		elif opt == '-b':
+			Compare.timing_baseline = HIDTestDatabase(None, kernel_release)
+			Compare.timing_baseline.load_results(arg)
+		elif opt in ('-c', '-p'):
+			try:
+				role, value = arg.split(':', 1)
+				if role not in sched_roles:
+					raise ValueError(role)
+				if opt == '-p':
+					parse_priority(value)
+			except ValueError:
+				print "invalid scheduling option", opt + arg
+				sys.exit(1)
+			if opt == '-c':
+				sched_cpus[role] = value
+			else:
+				sched_priorities[role] = value
+
+	if daemon_socket:
+		# forward the other arguments to the daemon
+		import hid_daemon
+		forwarded = [argv[0]] + [opt + arg for opt, arg in optlist if opt != '-D'] + args
+		sys.exit(hid_daemon.submit(daemon_socket, forwarded))
 
 	if not os.path.exists("/dev/uhid"):
 		print "It is required to load the uhid kernel module."
 		sys.exit(1)
 
+	if HIDTest.max_gap != None or HIDTest.speed != 1.0:
+		# the delays between the frames don't match the recordings anymore
+		if delta_timestamp:
+			print "the timestamps can not be checked when shortening the delays, ignoring -t."
+			delta_timestamp = 0
+		if Compare.perf_tracking:
+			print "the performance can not be tracked when shortening the delays, ignoring -T."
+			Compare.perf_tracking = False
+		Compare.ignore_timings = True
+
+	if bulk and (simple_evemu_mode or delta_timestamp or Compare.perf_tracking):
+		print "bulk mode is not compatible with -E, -t and -T, disabling it."
+		bulk = False
+
+	HIDTest.replay_sched = sched_prefix(sched_cpus.get("replay"), sched_priorities.get("replay"))
+	HIDTest.capture_sched = sched_prefix(sched_cpus.get("capture"), sched_priorities.get("capture"))
+
 	rootdir = '.'
 	if len(args) > 0:
 		rootdir = args[0]
@@ -192,26 +411,48 @@ def main():
 	list_of_evemu_files = []
 	if len(args) > 1:
 		files = args[1:]
-		list_of_hid_files = [ f for f in files if f.endswith(".hid") ]
-		list_of_evemu_files = [ f for f in files if f.endswith(".ev") ]
+		list_of_hid_files = [ recording_name(f) for f in files if recording_name(f).endswith(".hid") ]
+		list_of_evemu_files = [ f for f in files if recording_name(f).endswith(".ev") ]
 
 	if len(list_of_hid_files) + len(list_of_evemu_files) == 0:
-		help(sys.argv)
+		help(argv)
 		sys.exit(1)
 
-	if len(list_of_hid_files) > 0:
-		xi2detach = start_xi2detach()
+	if shard:
+		index, count = shard
+		list_of_hid_files = database.get_shard(list_of_hid_files, index, count, shard_weight)
+
+	# the scheduling of the test suite is restored at the end, the daemon
+	# runs other jobs afterwards
+	saved_sched = None
+	if sched_cpus.has_key("compare") or sched_priorities.has_key("compare"):
+		saved_sched = sched_state()
 
 	try:
+		sched_self(sched_cpus.get("compare"), sched_priorities.get("compare"))
+		jobs = max(EvemuFile.parse_jobs, Compare.matrix_jobs)
+		if jobs > 1 and not persistent:
+			# the workers are forked before any thread is started, the
+			# daemon already has its own
+			start_pool(jobs)
 		if len(list_of_hid_files) > 0:
-			run_tests(list_of_hid_files, database, simple_evemu_mode, delta_timestamp)
+			start_xi2detach()
+			run_tests(list_of_hid_files, database, simple_evemu_mode, delta_timestamp, bulk)
 		if len(list_of_evemu_files) > 0:
 			run_check(list_of_evemu_files, database, delta_timestamp)
 	finally:
 		if not simple_evemu_mode:
 			database.report_results()
+			if results_file:
+				database.dump_results(results_file)
 		if len(list_of_hid_files) > 0:
-			xi2detach.terminate()
+			stop_xi2detach()
+		if not persistent:
+			stop_pool()
+		if saved_sched:
+			sched_restore(saved_sched)
 
 if __name__ == "__main__":
+	# disable stdout buffering
+	sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 	main()
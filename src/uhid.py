@@ -0,0 +1,281 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Hid test suite / in-process replay of hid recordings through /dev/uhid
+#
+# Copyright (c) 2012-2013 Benjamin Tissoires <benjamin.tissoires@gmail.com>
+# Copyright (c) 2012-2013 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import errno
+import struct
+import select
+import binascii
+import threading
+import ctypes
+import ctypes.util
+import getopt
+from compare_evemu import open_recording
+
+uhid_path = "/dev/uhid"
+
+# from include/uapi/linux/uhid.h
+UHID_DESTROY = 1
+UHID_START = 2
+UHID_STOP = 3
+UHID_OPEN = 4
+UHID_CLOSE = 5
+UHID_OUTPUT = 6
+UHID_GET_REPORT = 9
+UHID_GET_REPORT_REPLY = 10
+UHID_CREATE2 = 11
+UHID_INPUT2 = 12
+UHID_SET_REPORT = 13
+UHID_SET_REPORT_REPLY = 14
+
+HID_MAX_DESCRIPTOR_SIZE = 4096
+UHID_DATA_MAX = 4096
+
+# sizeof(struct uhid_event), the biggest member being uhid_create2_req
+uhid_event_size = 4 + 128 + 64 + 64 + 2 + 2 + 4 * 4 + HID_MAX_DESCRIPTOR_SIZE
+
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
+
+class timespec(ctypes.Structure):
+	_fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+librt = ctypes.CDLL(ctypes.util.find_library("rt"), use_errno=True)
+librt.clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+librt.clock_nanosleep.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(timespec), ctypes.POINTER(timespec)]
+
+def monotonic():
+	''' returns the time of CLOCK_MONOTONIC in seconds '''
+	t = timespec()
+	if librt.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)):
+		e = ctypes.get_errno()
+		raise OSError(e, os.strerror(e))
+	return t.tv_sec + t.tv_nsec * 1e-9
+
+def sleep_until(deadline):
+	''' sleeps until CLOCK_MONOTONIC reaches deadline, without drifting '''
+	t = timespec(int(deadline), int((deadline - int(deadline)) * 1e9))
+	while librt.clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, ctypes.byref(t), None) == errno.EINTR:
+		pass
+
+def compress_delays(events, max_gap = None, speed = 1.0, start = 0.0):
+	''' returns the (time, data) events shifted to start at start, the delays
+	between them being divided by speed and capped to max_gap seconds '''
+	result = []
+	now = start
+	if events:
+		prev = events[0][0]
+	for t, data in events:
+		delay = max(0, t - prev) / speed
+		if max_gap != None:
+			delay = min(delay, max_gap)
+		now += delay
+		prev = t
+		result.append((now, data))
+	return result
+
+class HIDRecording(object):
+	''' the device and the reports of a .hid recording (hid-recorder) '''
+	def __init__(self, path):
+		self.name = ""
+		self.phys = ""
+		self.uniq = ""
+		self.bus = 0
+		self.vendor = 0
+		self.product = 0
+		self.rdesc = ""
+		# list of (time, data)
+		self.events = []
+		f = open_recording(path)
+		for line in f:
+			if line.startswith("E: "):
+				fields = line[3:].split()
+				self.events.append((float(fields[0]), binascii.unhexlify(''.join(fields[2:]))))
+			elif line.startswith("R: "):
+				self.rdesc = binascii.unhexlify(''.join(line[3:].split()[1:]))
+			elif line.startswith("N: "):
+				self.name = line[3:].rstrip('\n')
+			elif line.startswith("P: "):
+				self.phys = line[3:].rstrip('\n')
+			elif line.startswith("I: "):
+				self.bus, self.vendor, self.product = [int(i, 16) for i in line[3:].split()[:3]]
+			elif line.startswith("D: "):
+				f.close()
+				raise ValueError(path + ": several devices are not supported")
+		f.close()
+
+	def create_event(self):
+		''' the UHID_CREATE2 event of the device '''
+		return struct.pack("=I128s64s64sHHIIII", UHID_CREATE2,
+			self.name[:127], self.phys[:63], self.uniq[:63],
+			len(self.rdesc), self.bus, self.vendor, self.product, 0, 0) + self.rdesc
+
+	def input_events(self):
+		''' the list of (time, UHID_INPUT2 event) of the reports '''
+		return [(t, struct.pack("=IH", UHID_INPUT2, len(data)) + data) for t, data in self.events]
+
+class UHIDReplay(object):
+	''' replays a .hid recording through /dev/uhid in a thread of the current
+	process: creates the device, waits start_delay seconds, replays the
+	reports once, and destroys the device. It has the interface of the
+	subprocess.Popen of hid-replay used by HIDTest. '''
+	# delay between two reports in "as fast as possible" mode, to not
+	# overflow the buffers of the evdev clients
+	fast_delay = 0.001
+
+	def __init__(self, path, start_delay = 1.0, fast = False, max_gap = None, speed = 1.0):
+		recording = HIDRecording(path)
+		self.events = compress_delays(recording.input_events(), max_gap, speed)
+		self.start_delay = start_delay
+		self.fast = fast
+		self.returncode = None
+		self.running = True
+		self.fd = os.open(uhid_path, os.O_RDWR)
+		self.reader = threading.Thread(target=self.__read_events)
+		self.reader.daemon = True
+		self.writer = threading.Thread(target=self.__replay)
+		self.writer.daemon = True
+		try:
+			os.write(self.fd, recording.create_event())
+		except OSError:
+			os.close(self.fd)
+			raise
+		self.reader.start()
+		self.writer.start()
+
+	def __read_events(self):
+		''' answers the requests of the kernel, nobody is there to do it '''
+		while self.running:
+			if not select.select([self.fd], [], [], 0.1)[0]:
+				continue
+			try:
+				event = os.read(self.fd, uhid_event_size)
+			except OSError:
+				return
+			if len(event) < 4:
+				return
+			event_type = struct.unpack_from("=I", event)[0]
+			if event_type == UHID_GET_REPORT:
+				id = struct.unpack_from("=I", event, 4)[0]
+				os.write(self.fd, struct.pack("=IIHH", UHID_GET_REPORT_REPLY, id, errno.EIO, 0))
+			elif event_type == UHID_SET_REPORT:
+				id = struct.unpack_from("=I", event, 4)[0]
+				os.write(self.fd, struct.pack("=IIH", UHID_SET_REPORT_REPLY, id, errno.EIO))
+
+	def __wait(self, deadline):
+		''' returns False if the replay has been terminated meanwhile '''
+		# sleep by small steps to be able to stop, and then precisely
+		while self.running and deadline - monotonic() > 0.1:
+			sleep_until(monotonic() + 0.1)
+		sleep_until(deadline)
+		return self.running
+
+	def __replay(self):
+		returncode = 1
+		try:
+			start = monotonic() + self.start_delay
+			if self.events:
+				start -= self.events[0][0]
+			i = 0
+			for t, event in self.events:
+				if self.fast and i > 0:
+					deadline = monotonic() + UHIDReplay.fast_delay
+				else:
+					deadline = start + t
+				if not self.__wait(deadline):
+					break
+				os.write(self.fd, event)
+				i += 1
+			if i == len(self.events):
+				returncode = 0
+		except OSError, e:
+			print >> sys.stderr, "uhid:", e
+		finally:
+			self.running = False
+			self.reader.join()
+			try:
+				os.write(self.fd, struct.pack("=I", UHID_DESTROY))
+			except OSError:
+				pass
+			os.close(self.fd)
+			self.returncode = returncode
+
+	def poll(self):
+		return self.returncode
+
+	def wait(self):
+		while self.writer.isAlive():
+			self.writer.join(1)
+		return self.returncode
+
+	def terminate(self):
+		self.running = False
+
+def help(argv):
+	print argv[0], "[OPTION] HID_FILE\n"\
+"""Replays the hid recording HID_FILE through /dev/uhid.
+Where:
+ * OPTION is:
+	-h	print the help message.
+	-sN	wait N seconds after creating the device (default: 1).
+	-f	replay the reports as fast as possible instead of at the
+		recorded pace.
+	-gGAP	shorten the delays between two reports to GAP seconds at most.
+	-xFACTOR	replay the reports FACTOR times faster."""
+
+def main():
+	start_delay = 1.0
+	fast = False
+	max_gap = None
+	speed = 1.0
+	optlist, args = getopt.gnu_getopt(sys.argv[1:], 'hs:fg:x:')
+	for opt, arg in optlist:
+		if opt == '-h':
+			help(sys.argv)
+			sys.exit(0)
+		elif opt == '-s':
+			start_delay = float(arg)
+		elif opt == '-f':
+			fast = True
+		elif opt == '-g':
+			max_gap = float(arg)
+		elif opt == '-x':
+			speed = float(arg)
+
+	if len(args) != 1:
+		help(sys.argv)
+		sys.exit(1)
+
+	if speed <= 0:
+		print "the speed factor must be positive."
+		sys.exit(1)
+
+	replay = UHIDReplay(args[0], start_delay, fast, max_gap, speed)
+	try:
+		sys.exit(replay.wait())
+	except KeyboardInterrupt:
+		replay.terminate()
+		sys.exit(replay.wait())
+
+if __name__ == "__main__":
+	main()